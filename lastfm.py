@@ -7,17 +7,51 @@ love/ban tracks on behalf of a user. To love/ban tracks you will need your own
 API key and secret, which you can get from http://www.last.fm/api/account
 """
 
-# TODO Cache failure to love or ban
-
 CACHE_DIRECTORY = '/tmp/lastfm.py'
+SIMILAR_ARTISTS_URL = 'http://ws.audioscrobbler.com/2.0/artist/%s/similar.txt?limit=%i'
+LIBRARY_URL = 'http://www.last.fm/user/%s/library/%s?page=%i'
 SECONDS_BETWEEN_REQUESTS = 2
-__LAST_REQUEST_TIME = 0
+REQUEST_BURST = 3
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+SIMILAR_ARTISTS_TTL = 60 * 60 * 24 * 7
+SIMILAR_ARTISTS_CACHE_SIZE = 10000
+TRACKS_TTL = 60 * 60 * 24
+TRACKS_FULL_SYNC_INTERVAL = 60 * 60 * 24 * 30
+PAGE_WORKERS = 4
+LOVE_WORKERS = 4
+SESSION_KEY_TTL = 60 * 60 * 24 * 30
+FAILURE_THRESHOLD = 3
+FAILURE_BACKOFF = 30
+FAILURE_MAX_BACKOFF = 60 * 60
+OFFLINE = False
+__RATE_LIMITER = None
+__CIRCUIT_BREAKER = None
+__CONNECTION_POOL = None
+SIMILAR_ARTISTS_READ_SIZE = 8192
+__SIMILAR_ARTISTS_CACHE = None
+__ARTIST_GRAPH = None
 
+import array
+import fcntl
 import htmlentitydefs
+import httplib
+import marshal
+import operator
 import os
 import re
+import socket
+import struct
+import tempfile
+import threading
 import time
 import urllib
+import urlparse
+
+try:
+   import sqlite3
+except ImportError:
+   sqlite3 = None
 
 if not os.path.isdir(CACHE_DIRECTORY):
    os.mkdir(CACHE_DIRECTORY)
@@ -38,7 +72,7 @@ def get_banned_tracks(username, logger=None): # {{{1
    """
    return __get_tracks(username, 'banned', logger)
 
-def get_similar_artists(artist, limit=100, logger=None): # {{{1
+def get_similar_artists(artist, limit=100, logger=None, block=True): # {{{1
    """
    Get a list of artists similar to the given artist from Last.fm. Returns
    a list of dictionaries, where each dictionary contains the following
@@ -49,30 +83,502 @@ def get_similar_artists(artist, limit=100, logger=None): # {{{1
     * "name": the name of the artist,
     * "key": the simplified name.
 
-   The list is sorted from most to least similar artist.
+   The list is sorted from most to least similar artist. Results are cached
+   for SIMILAR_ARTISTS_TTL seconds (see SimilarArtistsCache). When block is
+   False and the rate limit doesn't allow a request right now, expired
+   cached results are returned instead of waiting (if there are any).
+
+   While Last.fm is unavailable (see CircuitBreaker) no requests are made
+   and expired cached results are returned. When there are none an IOError
+   is raised, or when block is False an empty list is returned so that the
+   caller can carry on without similar artists. When OFFLINE is True the
+   results come from the ArtistGraph and Last.fm is never contacted.
    """
-   address = 'http://ws.audioscrobbler.com/2.0/artist/%s/similar.txt?limit=%i'
    results = []
    if artist != '':
       artist_key = normalize_name(artist)
+      if OFFLINE:
+         return [{ 'similarity': similarity, 'uuid': '', 'name': name, 'key': similar_key } \
+               for (similarity, name, similar_key) in get_artist_graph(logger).neighbours(artist_key, limit)]
+      cache = __get_similar_artists_cache()
+      if cache:
+         results = cache.get(artist_key, limit)
+         if results is not None:
+            return results
+      if not get_circuit_breaker().allow():
+         results = cache and cache.get(artist_key, limit, stale=True)
+         if results is not None:
+            if logger:
+               logger.debug("Using expired similar artists of `%s' because Last.fm is unavailable", artist)
+            return results
+         if block:
+            raise IOError('Last.fm is unavailable')
+         return []
+      if block:
+         __sleep(logger=logger)
+      elif not get_rate_limiter().try_acquire():
+         results = cache and cache.get(artist_key, limit, stale=True)
+         if results is not None:
+            if logger:
+               logger.debug("Using expired similar artists of `%s' to avoid waiting for Last.fm", artist)
+            return results
+         __sleep(logger=logger)
       param = urllib.quote(artist_key.encode('UTF-8'))
-      __sleep(logger=logger)
       if logger:
          logger.debug("Searching for normalized artist name `%s' (original: `%s')", artist_key, artist)
-      handle = urllib.urlopen(address % (param, limit))
-      lines = handle.read().decode('utf-8').split('\n')
-      handle.close()
-      for record in [line.split(",") for line in lines]:
-         if len(record) == 3:
-            similarity, uuid, similar_artist = record
-            similar_artist = __htmlentitydecode(similar_artist)
-            similar_key = normalize_name(similar_artist)
-            if similar_key != artist_key:
-               results.append({ 'similarity': float(similarity), 'uuid': uuid, \
-                     'name': similar_artist, 'key': similar_key })
-      results.sort(lambda x, y: -cmp(x['similarity'], y['similarity']))
+      def parse(handle):
+         return __parse_similar_artists(handle, artist_key, limit)
+      try:
+         results = __fetch(SIMILAR_ARTISTS_URL % (param, limit), logger, parse)
+      except (IOError, socket.error), e:
+         if block:
+            raise
+         results = cache and cache.get(artist_key, limit, stale=True)
+         if logger:
+            logger.warning("Failed to get similar artists of `%s' from Last.fm (%s)%s", artist,
+                  e, results is not None and ', using expired results' or '')
+         return results or []
+      if cache:
+         cache.put(artist_key, limit, results)
+      if __ARTIST_GRAPH is not None:
+         __ARTIST_GRAPH.add(artist_key, artist, [(r['similarity'], r['name'], r['key']) for r in results])
    return results
 
+def get_cached_similar_artists(artist, limit=100, logger=None): # {{{1
+   """
+   Get the artists similar to the given artist like get_similar_artists()
+   does, but only from the cache (expired results included) and from the
+   ArtistGraph, so that Last.fm is never contacted and the caller never has
+   to wait. Returns None when nothing is known about the artist yet.
+   """
+   if artist == '':
+      return []
+   artist_key = normalize_name(artist)
+   if not OFFLINE:
+      cache = __get_similar_artists_cache()
+      if cache:
+         results = cache.get(artist_key, limit)
+         if results is None:
+            results = cache.get(artist_key, limit, stale=True)
+         if results is not None:
+            return results
+   graph = OFFLINE and get_artist_graph(logger) or __ARTIST_GRAPH
+   if graph is not None:
+      neighbours = graph.neighbours(artist_key, limit)
+      if neighbours:
+         return [{ 'similarity': similarity, 'uuid': '', 'name': name, 'key': similar_key } \
+               for (similarity, name, similar_key) in neighbours]
+   if OFFLINE:
+      return []
+   return None
+
+def similar_artists_cache_statistics(): # {{{1
+   """
+   Get a dictionary with the number of "hits" and "misses" of the cache used
+   by get_similar_artists() and the number of cached "artists".
+   """
+   cache = __get_similar_artists_cache()
+   if cache:
+      return cache.statistics()
+   return { 'hits': 0, 'misses': 0, 'artists': 0 }
+
+class SimilarArtistsCache: # {{{1
+   """
+   Persistent cache for the results of get_similar_artists(), stored in an
+   SQLite database so that it's shared between processes and survives
+   restarts. Entries expire after ttl seconds and when more than size
+   artists are cached the least recently used ones are evicted. The most
+   recently used entries are also kept in memory, so the hot path doesn't
+   touch the database at all. Their access times are written to the
+   database at most every ACCESS_FLUSH_INTERVAL seconds and before anything
+   is evicted.
+   """
+
+   MEMORY_SIZE = 200
+   ACCESS_FLUSH_INTERVAL = 60
+
+   def __init__(self, filename, ttl, size): # {{{2
+      self.ttl = ttl
+      self.size = size
+      self.hits = 0
+      self.misses = 0
+      self.__memory = {}
+      # Keys of the entries in memory that were used since the last flush.
+      self.__accessed = set()
+      self.__flushed = time.time()
+      self.__lock = threading.Lock()
+      self.__db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+      # Losing the last few changes after a crash is fine for a cache.
+      self.__db.execute("PRAGMA synchronous = OFF")
+      self.__db.execute("""CREATE TABLE IF NOT EXISTS similar_artists (
+            artist TEXT PRIMARY KEY, size INTEGER, fetched REAL, accessed REAL, results BLOB)""")
+      self.__db.execute("CREATE INDEX IF NOT EXISTS similar_artists_accessed ON similar_artists (accessed)")
+      self.__db.commit()
+
+   def get(self, key, limit, ttl=None, stale=False): # {{{2
+      """
+      Get the cached list of similar artists for the given normalized artist
+      name. Returns None when there are no cached results with at least limit
+      artists that are younger than ttl seconds (by default self.ttl). When
+      stale is True the age of the results doesn't matter. Such lookups are
+      fallbacks after a miss, so they don't count as hits or misses.
+      """
+      if ttl is None: ttl = self.ttl
+      now = time.time()
+      self.__lock.acquire()
+      try:
+         entry = self.__memory.get(key)
+         if entry is None:
+            row = self.__db.execute("SELECT size, fetched, results FROM similar_artists WHERE artist = ?", (key,)).fetchone()
+            if row:
+               self.__db.execute("UPDATE similar_artists SET accessed = ? WHERE artist = ?", (now, key))
+               entry = self.__remember(key, row[0], row[1], marshal.loads(str(row[2])))
+               self.__db.commit()
+         if entry is None or entry[1] < limit or (now - entry[2] > ttl and not stale):
+            if not stale:
+               self.misses += 1
+            return None
+         entry[0] = now
+         self.__accessed.add(key)
+         if now - self.__flushed > self.ACCESS_FLUSH_INTERVAL:
+            self.__flush()
+            self.__db.commit()
+         if not stale:
+            self.hits += 1
+         records = entry[3]
+      finally:
+         self.__lock.release()
+      return [{ 'similarity': similarity, 'uuid': uuid, 'name': name, 'key': similar_key } \
+            for (similarity, uuid, name, similar_key) in records[:limit]]
+
+   def put(self, key, limit, results): # {{{2
+      """
+      Cache the list of similar artists for the given normalized artist name.
+      """
+      now = time.time()
+      records = [(r['similarity'], r['uuid'], r['name'], r['key']) for r in results]
+      self.__lock.acquire()
+      try:
+         self.__remember(key, limit, now, records)
+         self.__db.execute("INSERT OR REPLACE INTO similar_artists VALUES (?, ?, ?, ?, ?)",
+               (key, limit, now, now, buffer(marshal.dumps(records))))
+         count = self.__db.execute("SELECT COUNT(*) FROM similar_artists").fetchone()[0]
+         if count > self.size:
+            # Entries that are only used from memory aren't the least recently
+            # used ones.
+            self.__flush()
+            self.__db.execute("""DELETE FROM similar_artists WHERE artist IN (SELECT artist
+                  FROM similar_artists ORDER BY accessed LIMIT ?)""", (count - self.size,))
+         self.__db.commit()
+      finally:
+         self.__lock.release()
+
+   def records(self, since=0): # {{{2
+      """
+      Get a list of (key, records) tuples for all artists cached after the
+      given time, whether they've expired or not. The records are tuples of
+      (similarity, uuid, name, key).
+      """
+      self.__lock.acquire()
+      try:
+         rows = self.__db.execute("SELECT artist, results FROM similar_artists WHERE fetched > ?", (since,)).fetchall()
+      finally:
+         self.__lock.release()
+      return [(key, marshal.loads(str(blob))) for (key, blob) in rows]
+
+   def statistics(self): # {{{2
+      self.__lock.acquire()
+      try:
+         count = self.__db.execute("SELECT COUNT(*) FROM similar_artists").fetchone()[0]
+      finally:
+         self.__lock.release()
+      return { 'hits': self.hits, 'misses': self.misses, 'artists': count }
+
+   def __remember(self, key, limit, fetched, records): # {{{2
+      # Entries are lists of [accessed, limit, fetched, records].
+      if len(self.__memory) >= self.MEMORY_SIZE and key not in self.__memory:
+         oldest, entry = min(self.__memory.iteritems(), key=lambda item: item[1][0])
+         del self.__memory[oldest]
+         # Hits on entries in memory aren't written to the database right away.
+         self.__db.execute("UPDATE similar_artists SET accessed = ? WHERE artist = ?", (entry[0], oldest))
+         self.__accessed.discard(oldest)
+      entry = [time.time(), limit, fetched, records]
+      self.__memory[key] = entry
+      return entry
+
+   def __flush(self): # {{{2
+      # Write the access times of the entries used from memory to the database.
+      self.__db.executemany("UPDATE similar_artists SET accessed = ? WHERE artist = ?",
+            [(self.__memory[key][0], key) for key in self.__accessed if key in self.__memory])
+      self.__accessed.clear()
+      self.__flushed = time.time()
+
+def get_artist_graph(logger=None): # {{{1
+   """
+   Get the ArtistGraph with all similar artists ever retrieved from Last.fm.
+   The graph is loaded from CACHE_DIRECTORY the first time and brought up to
+   date with the SimilarArtistsCache, after which get_similar_artists() adds
+   new results to it. Use save_artist_graph() to make the additions persist.
+   """
+   global __ARTIST_GRAPH
+   if __ARTIST_GRAPH is None:
+      graph = ArtistGraph()
+      if graph.load(__artist_graph_fname()) and logger:
+         logger.info('Loaded artist graph with %i artists and %i similar artists', len(graph), graph.edges)
+      cache = __get_similar_artists_cache()
+      if cache:
+         started = time.time()
+         records = cache.records(graph.updated)
+         for (key, entries) in records:
+            graph.add(key, None, [(similarity, name, similar_key) for (similarity, uuid, name, similar_key) in entries])
+         graph.updated = started
+         if records and logger:
+            logger.info('Added %i artists from the similar artists cache to the artist graph', len(records))
+      __ARTIST_GRAPH = graph
+   return __ARTIST_GRAPH
+
+def save_artist_graph(): # {{{1
+   """
+   Save the ArtistGraph returned by get_artist_graph() (if it was used).
+   """
+   if __ARTIST_GRAPH is not None:
+      __ARTIST_GRAPH.save(__artist_graph_fname())
+
+def import_similar_artists(filename, logger=None): # {{{1
+   """
+   Import similar artists from a dump file into the ArtistGraph and save it.
+   Each line of the file (encoded in UTF-8) contains the name of an artist,
+   the name of a similar artist and their similarity (between 0 and 100),
+   separated by tabs. Empty lines and lines starting with # are ignored.
+   Returns the number of imported artists.
+   """
+   artists = {}
+   names = {}
+   handle = open(filename, 'r')
+   try:
+      for line in handle:
+         line = line.decode('utf-8').rstrip('\r\n')
+         if line == '' or line.startswith('#'):
+            continue
+         fields = line.split('\t')
+         if len(fields) != 3:
+            if logger:
+               logger.warning("Ignoring invalid line in `%s': %r", filename, line)
+            continue
+         artist, similar_artist, similarity = fields
+         key = normalize_name(artist)
+         similar_key = normalize_name(similar_artist)
+         if key != similar_key:
+            names.setdefault(key, artist)
+            artists.setdefault(key, []).append((float(similarity), similar_artist, similar_key))
+   finally:
+      handle.close()
+   graph = get_artist_graph(logger)
+   for key, records in artists.iteritems():
+      graph.add(key, names[key], records)
+   save_artist_graph()
+   if logger:
+      logger.info("Imported %i artists from `%s' into the artist graph", len(artists), filename)
+   return len(artists)
+
+class ArtistGraph: # {{{1
+   """
+   Graph of similar artists that's never expired, so that similar artists
+   can be found without contacting Last.fm. Artists are identified by
+   numbers and the similar artists of each artist are stored in a pair of
+   arrays (numbers and similarities) sorted from most to least similar, so
+   the top k similar artists are a slice and hundreds of thousands of edges
+   take up little memory. The graph is saved to disk using marshal.
+   """
+
+   VERSION = 1
+   # Every artist reached by expand() contributes at most this many of its
+   # most similar artists, and only this many of the best artists reached in
+   # one step are expanded in the next step, so that the cost of expand()
+   # doesn't depend on the size of the graph.
+   EXPAND_FANOUT = 20
+   EXPAND_WIDTH = 100
+   EXPANSIONS_CACHE_SIZE = 500
+
+   def __init__(self): # {{{2
+      self.__ids = {}
+      self.__keys = []
+      self.__names = []
+      self.__neighbours = []
+      self.__expansions = {}
+      self.__lock = threading.Lock()
+      self.edges = 0
+      # Time of the last update from the SimilarArtistsCache.
+      self.updated = 0
+
+   def __len__(self): # {{{2
+      # The number of artists with similar artists.
+      return len(self.__neighbours) - self.__neighbours.count(None)
+
+   def add(self, key, name, records): # {{{2
+      """
+      Set the similar artists of the artist with the given normalized name.
+      The records are tuples of (similarity, name, key). The name of the
+      artist itself may be None when it isn't known.
+      """
+      records = sorted(records, reverse=True)
+      self.__lock.acquire()
+      try:
+         id = self.__id(key, name)
+         ids = array.array('i', [self.__id(k, n) for (s, n, k) in records])
+         similarities = array.array('f', [s for (s, n, k) in records])
+         previous = self.__neighbours[id]
+         if previous is not None:
+            # Results fetched again usually haven't changed, in which case
+            # the remembered neighbourhoods are still right.
+            if previous[0] == ids and previous[1] == similarities:
+               return
+            self.edges -= len(previous[0])
+         self.__neighbours[id] = (ids, similarities)
+         self.edges += len(ids)
+         self.__expansions = {}
+      finally:
+         self.__lock.release()
+
+   def neighbours(self, key, limit=None): # {{{2
+      """
+      Get the (at most limit) artists most similar to the artist with the
+      given normalized name as a list of (similarity, name, key) tuples.
+      """
+      id = self.__ids.get(key)
+      if id is None or self.__neighbours[id] is None:
+         return []
+      ids, similarities = self.__neighbours[id]
+      names = self.__names
+      keys = self.__keys
+      return [(similarities[i], names[ids[i]], keys[ids[i]]) for i in xrange(min(limit or len(ids), len(ids)))]
+
+   def expand(self, key, hops=2, decay=0.5, accept=None, limit=100): # {{{2
+      """
+      Find artists up to the given number of steps away from the artist with
+      the given normalized name. The weight of a path is the product of the
+      similarities (as fractions) along it, multiplied by decay for every
+      step after the first; each artist gets the weight of its best path
+      (scaled to 0-100 like similarities). Returns at most limit (weight,
+      name, key) tuples sorted from highest to lowest weight, leaving out
+      artists for which accept(name) returns False. The neighbourhood of
+      each artist is remembered until the graph changes.
+      """
+      self.__lock.acquire()
+      try:
+         seed = self.__ids.get(key)
+         if seed is None:
+            return []
+         memokey = (seed, hops, decay)
+         expansion = self.__expansions.get(memokey)
+         if expansion is None:
+            expansion = self.__expand(seed, hops, decay)
+            if len(self.__expansions) >= self.EXPANSIONS_CACHE_SIZE:
+               self.__expansions = {}
+            self.__expansions[memokey] = expansion
+         results = []
+         for (weight, id) in expansion:
+            name = self.__names[id]
+            if accept is None or accept(name):
+               results.append((weight, name, self.__keys[id]))
+               if len(results) == limit:
+                  break
+         return results
+      finally:
+         self.__lock.release()
+
+   def __expand(self, seed, hops, decay): # {{{2
+      neighbours = self.__neighbours
+      best = {}
+      frontier = [(1.0, seed)]
+      for hop in xrange(hops):
+         # All similar artists of the seed are used, but only the most
+         # similar ones of the artists reached after that.
+         fanout = None if hop == 0 else self.EXPAND_FANOUT
+         factor = 100.0 * decay ** hop
+         reached = {}
+         for (weight, id) in frontier:
+            if neighbours[id] is not None:
+               ids, similarities = neighbours[id]
+               for i in xrange(min(fanout or len(ids), len(ids))):
+                  other = ids[i]
+                  pathweight = weight * similarities[i] / 100.0
+                  if pathweight > reached.get(other, 0):
+                     reached[other] = pathweight
+         reached.pop(seed, None)
+         for (other, pathweight) in reached.iteritems():
+            if pathweight * factor > best.get(other, 0):
+               best[other] = pathweight * factor
+         frontier = [(w, i) for (i, w) in reached.iteritems()]
+         frontier.sort(reverse=True)
+         del frontier[self.EXPAND_WIDTH:]
+      expansion = [(w, i) for (i, w) in best.iteritems()]
+      expansion.sort(reverse=True)
+      return expansion
+
+   def save(self, filename): # {{{2
+      """
+      Save the graph to the given file.
+      """
+      self.__lock.acquire()
+      try:
+         neighbours = [n and (n[0].tostring(), n[1].tostring()) for n in self.__neighbours]
+         snapshot = (self.VERSION, self.updated, self.__keys, self.__names, neighbours)
+         # Write to a temporary file first so readers never see half a graph.
+         descriptor, tempname = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', dir=os.path.dirname(filename))
+         handle = os.fdopen(descriptor, 'wb')
+         try:
+            marshal.dump(snapshot, handle)
+         finally:
+            handle.close()
+         os.rename(tempname, filename)
+      finally:
+         self.__lock.release()
+
+   def load(self, filename): # {{{2
+      """
+      Load a graph saved by save(). Returns False when the file doesn't exist
+      or can't be used, in which case the graph is left untouched.
+      """
+      try:
+         handle = open(filename, 'rb')
+         try:
+            snapshot = marshal.load(handle)
+         finally:
+            handle.close()
+      except (IOError, EOFError, ValueError, TypeError):
+         return False
+      if type(snapshot) != type(()) or len(snapshot) != 5 or snapshot[0] != self.VERSION:
+         return False
+      version, self.updated, self.__keys, self.__names, neighbours = snapshot
+      self.__ids = dict([(k, i) for (i, k) in enumerate(self.__keys)])
+      self.__expansions = {}
+      self.__neighbours = []
+      self.edges = 0
+      for entry in neighbours:
+         if entry:
+            ids = array.array('i')
+            ids.fromstring(entry[0])
+            similarities = array.array('f')
+            similarities.fromstring(entry[1])
+            entry = (ids, similarities)
+            self.edges += len(ids)
+         self.__neighbours.append(entry)
+      return True
+
+   def __id(self, key, name): # {{{2
+      id = self.__ids.get(key)
+      if id is None:
+         id = len(self.__keys)
+         self.__ids[key] = id
+         self.__keys.append(key)
+         self.__names.append(name or key)
+         self.__neighbours.append(None)
+      elif name and self.__names[id] == key:
+         # Replace the placeholder with the real name.
+         self.__names[id] = name
+      return id
+
 def love_tracks(options, tracks, logger=None): # {{{1
    """
    Love the given track(s) on Last.fm for the given user. The options
@@ -108,124 +614,694 @@ def ban_tracks(options, tracks, logger=None): # {{{1
    return __set_tracks(options, tracks, 'ban', logger)
 
 def __get_tracks(username, type, logger): # {{{1
-   # Return cached results when they exist.
+   """
+   Get the loved or banned tracks of a user. The tracks are cached and the
+   cache is used as is for TRACKS_TTL seconds. After that only the newest
+   tracks are downloaded from Last.fm (see __sync_new_tracks()), except
+   when the last full download is more than TRACKS_FULL_SYNC_INTERVAL
+   seconds old (tracks that are no longer loved or banned are only removed
+   from the cache by a full download). When OFFLINE is True only the cache
+   is used.
+   """
    cachefile = __cached_tracks_fname(username, type)
-   if os.path.exists(cachefile):
+   cached = __load_cached_tracks(cachefile)
+   now = time.time()
+   if cached:
+      fullsync, tracks = cached
+      if OFFLINE or now - os.path.getmtime(cachefile) < TRACKS_TTL:
+         if logger:
+            logger.info('Returning cached %s tracks from %s', type, cachefile)
+         return tracks
+   if OFFLINE:
+      return []
+   try:
+      if cached and now - fullsync < TRACKS_FULL_SYNC_INTERVAL:
+         tracks = __sync_new_tracks(username, type, tracks, logger)
+      else:
+         fullsync = now
+         if logger:
+            logger.debug('Downloading page 1 with %s tracks', type)
+         tracks, lastpage = __get_tracks_page(username, type, 1)
+         # Once we know the number of pages the remaining pages can be
+         # downloaded in parallel.
+         for pagetracks in __get_tracks_pages(username, type, range(2, lastpage + 1), logger):
+            tracks.extend(pagetracks)
+         if logger:
+            logger.info('Finished downloading %i %s tracks from Last.fm', len(tracks), type)
+   except IOError:
+      if not cached:
+         raise
       if logger:
-        logger.info('Returning cached %s tracks from %s', type, cachefile)
-      handle = open(cachefile, 'r')
-      tracks = eval(handle.read())
-      handle.close()
-      return tracks
-   # Otherwise get results from Last.fm.
-   tracks = []
-   address = 'http://www.last.fm/user/%s/library/%s?page=%i'
-   pattern = '<td class="subjectCell">\s*<a href="[^"]+">(.+?)</a>.+?<a href="[^"]+">(.+?)</a>\s*</td>'
+         logger.warning('Failed to update the %s tracks from Last.fm, using cached tracks', type)
+      return cached[1]
+   # Cache results before returning them.
+   __save_cached_tracks(cachefile, fullsync, tracks)
+   return tracks
+
+def __sync_new_tracks(username, type, tracks, logger): # {{{1
+   """
+   Add the tracks that were loved or banned since the given list of tracks
+   was downloaded. Last.fm lists the newest tracks first, so we download
+   pages until we find a track we already know about.
+   """
+   known = set(tracks)
+   newtracks = []
    pagenr = 1
-   lastpage = None
-   while lastpage == None or pagenr <= lastpage:
-      __sleep()
+   lastpage = 1
+   while pagenr <= lastpage:
       if logger:
-         logger.debug('Downloading page %i of %s with %s tracks',
-               pagenr, lastpage == None and '?' or str(lastpage), type)
-      handle = urllib.urlopen(address % (username, type, pagenr))
-      source = handle.read().decode('utf-8')
-      handle.close()
-      for (artist, track) in re.findall(pattern, source, re.DOTALL | re.IGNORECASE):
-         tracks.append((__htmlentitydecode(artist), __htmlentitydecode(track)))
-      if pagenr == 1 and lastpage == None:
-         match = re.search('<a\s.*?class="lastpage">(\d+)</a>', source, re.IGNORECASE)
-         lastpage = match and int(match.group(1)) or 1
+         logger.debug('Downloading page %i with new %s tracks', pagenr, type)
+      pagetracks, lastpage = __get_tracks_page(username, type, pagenr)
+      for track in pagetracks:
+         if track in known:
+            # Stop at the first track we already know about.
+            lastpage = 0
+            break
+         newtracks.append(track)
       pagenr += 1
    if logger:
-      logger.info('Finished downloading %i %s tracks from Last.fm', len(tracks), type)
-   # Cache results before returning them.
-   handle = open(cachefile, 'w')
-   handle.write(str(tracks))
-   handle.close()
-   return tracks
+      logger.info('Found %i new %s tracks on Last.fm', len(newtracks), type)
+   return newtracks + tracks
+
+def __get_tracks_pages(username, type, pagenrs, logger): # {{{1
+   """
+   Download several pages of loved or banned tracks using up to PAGE_WORKERS
+   threads. Each request still waits for the rate limiter, so the workers
+   only hide the latency of the requests. Returns the lists of tracks in
+   the same order as the given page numbers. When downloading a page fails
+   the remaining pages are skipped and the error is raised.
+   """
+   def download(pagenr):
+      if logger:
+         logger.debug('Downloading page %i of %i with %s tracks', pagenr, pagenrs[-1], type)
+      return __get_tracks_page(username, type, pagenr)[0]
+   results, errors = __map_concurrently(download, pagenrs, PAGE_WORKERS, True)
+   if errors:
+      raise errors[0][1]
+   return results
+
+def __map_concurrently(function, items, workers, stop_on_error): # {{{1
+   """
+   Call function for each of the items using up to the given number of
+   threads. Returns a tuple with the list of results (in the same order as
+   the items, None for items that failed or were skipped) and a list of
+   (index, exception) tuples for the items that failed. When stop_on_error
+   is True no new items are started after the first failure.
+   """
+   pending = range(len(items))
+   pending.reverse()
+   results = [None] * len(items)
+   errors = []
+   lock = threading.Lock()
+   def worker():
+      while True:
+         lock.acquire()
+         try:
+            if (errors and stop_on_error) or not pending:
+               return
+            index = pending.pop()
+         finally:
+            lock.release()
+         try:
+            results[index] = function(items[index])
+         except Exception, e:
+            lock.acquire()
+            errors.append((index, e))
+            lock.release()
+   threads = []
+   for i in xrange(min(workers, len(items))):
+      thread = threading.Thread(target=worker)
+      thread.setDaemon(True)
+      thread.start()
+      threads.append(thread)
+   for thread in threads:
+      thread.join()
+   errors.sort()
+   return results, errors
+
+def __get_tracks_page(username, type, pagenr): # {{{1
+   """
+   Download a page of loved or banned tracks. Returns a tuple with the list
+   of tracks and the number of pages.
+   """
+   pattern = '<td class="subjectCell">\s*<a href="[^"]+">(.+?)</a>.+?<a href="[^"]+">(.+?)</a>\s*</td>'
+   if not get_circuit_breaker().allow():
+      raise IOError('Last.fm is unavailable')
+   __sleep()
+   source = __fetch(LIBRARY_URL % (username, type, pagenr))
+   tracks = []
+   for (artist, track) in re.findall(pattern, source, re.DOTALL | re.IGNORECASE):
+      tracks.append((__htmlentitydecode(artist), __htmlentitydecode(track)))
+   match = re.search('<a\s.*?class="lastpage">(\d+)</a>', source, re.IGNORECASE)
+   return tracks, match and int(match.group(1)) or 1
+
+def __load_cached_tracks(cachefile): # {{{1
+   """
+   Load cached tracks saved by __save_cached_tracks(). Returns a tuple with
+   the time of the last full download and the list of tracks, or None.
+   """
+   try:
+      handle = open(cachefile, 'rb')
+      try:
+         version, fullsync, tracks = marshal.load(handle)
+      finally:
+         handle.close()
+   except (IOError, EOFError, ValueError, TypeError):
+      return None
+   if version != TRACKS_CACHE_VERSION:
+      return None
+   return fullsync, tracks
+
+def __save_cached_tracks(cachefile, fullsync, tracks): # {{{1
+   # The modification time of the file is the time of the last update.
+   descriptor, tempname = tempfile.mkstemp(prefix=os.path.basename(cachefile) + '.', dir=CACHE_DIRECTORY)
+   handle = os.fdopen(descriptor, 'wb')
+   try:
+      marshal.dump((TRACKS_CACHE_VERSION, fullsync, tracks), handle)
+   finally:
+      handle.close()
+   os.rename(tempname, cachefile)
+
+# Increase this when the format of the cached tracks changes.
+TRACKS_CACHE_VERSION = 2
 
 def __set_tracks(options, tracks, action, logger): # {{{1
    """
    A private helper method to love and ban tracks, because the code
-   involved in doing so is almost exactly the same.
+   involved in doing so is almost exactly the same. The tracks are sent to
+   Last.fm by up to LOVE_WORKERS threads which share the rate limit of all
+   other requests. Tracks that Last.fm refused while other tracks went
+   through are appended to a log and won't be tried again.
    """
+   if OFFLINE:
+      raise IOError('Not contacting Last.fm in offline mode')
    # Only import the pylast module when it's needed.
    import pylast
    # Unpack the options dictionary.
    username = options.get('username')
-   password = pylast.md5(options.get('password'))
    api_key = options.get('api_key')
    api_secret = options.get('api_secret')
-   # Create a Last.fm session key.
-   generator = pylast.SessionKeyGenerator(api_key, api_secret)
-   session_key = generator.get_session_key(username, password)
-   # Read the list of tracks that previously failed to get loved or banned?
-   cachefile = __cached_failures_fname(username, action)
-   previous_failures = []
-   if os.path.exists(cachefile):
-      handle = open(cachefile, 'r')
-      previous_failures = eval(handle.read())
-   # Love or ban the given tracks.
-   failed_tracks = []
-   cache_dirty = False
-   for index, [artist, title] in enumerate(tracks):
-      try:
-         # Don't retry previously failed tracks.
-         if (artist, title) not in previous_failures:
-            if logger:
-               logger.info('%s track %i of %i\n',
-                  action == 'love' and 'Loving' or 'Banning', index+1, len(tracks))
-            __sleep()
-            track = pylast.Track(artist, title, api_key, api_secret, session_key)
-            if action == 'love': track.love()
-            elif action == 'ban': track.ban()
-            cache_dirty = True
-      except:
-         failed_tracks.append([artist, title])
-   # Delete the cached tracks because the cache is stale?
-   if cache_dirty:
+   session_key = __get_session_key(options, logger)
+   # Don't retry tracks that previously failed to get loved or banned.
+   logfile = __cached_failures_fname(username, action)
+   previous_failures = __load_failures(logfile)
+   todo = [(artist, title) for [artist, title] in tracks \
+         if __failure_key(artist, title) not in previous_failures]
+   progress = [0]
+   lock = threading.Lock()
+   def submit(track):
+      lock.acquire()
+      progress[0] += 1
+      if logger:
+         logger.info('%s track %i of %i', action == 'love' and 'Loving' or 'Banning', progress[0], len(todo))
+      lock.release()
+      __sleep()
+      track = pylast.Track(track[0], track[1], api_key, api_secret, session_key)
+      if action == 'love': track.love()
+      elif action == 'ban': track.ban()
+   results, errors = __map_concurrently(submit, todo, LOVE_WORKERS, False)
+   failed_tracks = [list(todo[index]) for (index, error) in errors]
+   # Mark the cached tracks as expired so the new tracks are synced?
+   if len(failed_tracks) < len(todo):
       cachefile = __cached_tracks_fname(username, action == 'love' and 'loved' or 'banned')
-      if os.path.exists(cachefile): os.remove(cachefile)
-   # Cache the tracks that failed?
-   if len(failed_tracks) != 0:
-      cachefile = __cached_failures_fname(username, action)
-      handle = open(cachefile, 'w')
-      handle.write(str(previous_failures + failed_tracks))
-      handle.close()
+      if os.path.exists(cachefile): os.utime(cachefile, (0, 0))
+      # Remember the tracks that failed because of the track itself, not
+      # because of the network.
+      refused = [list(todo[index]) for (index, error) in errors \
+            if not isinstance(error, (IOError, socket.error))]
+      if refused:
+         __log_failures(logfile, refused)
+   elif todo:
+      # Nothing worked, maybe the session key is no longer valid or Last.fm
+      # is unavailable, so none of the tracks are to blame.
+      __forget_session_key(username)
    # Return the list of tracks that failed.
    return failed_tracks
 
+def __get_session_key(options, logger): # {{{1
+   """
+   Get a Last.fm session key for the user and API key in the options given to
+   love_tracks() or ban_tracks(). Session keys are cached for
+   SESSION_KEY_TTL seconds in a file that only the user can read.
+   """
+   import pylast
+   username = options.get('username')
+   api_key = options.get('api_key')
+   cachefile = __cached_session_key_fname(username)
+   try:
+      handle = open(cachefile, 'rb')
+      try:
+         cached_api_key, session_key, created = marshal.load(handle)
+      finally:
+         handle.close()
+      if cached_api_key == api_key and time.time() - created < SESSION_KEY_TTL:
+         return session_key
+   except (IOError, EOFError, ValueError, TypeError):
+      pass
+   if logger:
+      logger.debug('Creating a new Last.fm session key for %s', username)
+   generator = pylast.SessionKeyGenerator(api_key, options.get('api_secret'))
+   session_key = generator.get_session_key(username, pylast.md5(options.get('password')))
+   # mkstemp() creates the file with mode 0600 and won't follow a symbolic
+   # link that somebody put in the (world writable) cache directory.
+   descriptor, tempname = tempfile.mkstemp(prefix=os.path.basename(cachefile) + '.', dir=CACHE_DIRECTORY)
+   handle = os.fdopen(descriptor, 'wb')
+   try:
+      marshal.dump((api_key, session_key, time.time()), handle)
+   finally:
+      handle.close()
+   os.rename(tempname, cachefile)
+   return session_key
+
+def __forget_session_key(username): # {{{1
+   cachefile = __cached_session_key_fname(username)
+   if os.path.exists(cachefile):
+      os.unlink(cachefile)
+
+def __load_failures(logfile): # {{{1
+   """
+   Read the log of tracks that failed to get loved or banned. Each line of
+   the log contains an artist and a title separated by a tab. Returns a set
+   of (artist, title) tuples.
+   """
+   failures = set()
+   if os.path.exists(logfile):
+      handle = open(logfile, 'r')
+      try:
+         for line in handle:
+            fields = line.decode('utf-8').rstrip('\n').split('\t')
+            if len(fields) == 2:
+               failures.add(tuple(fields))
+      finally:
+         handle.close()
+   return failures
+
+def __log_failures(logfile, tracks): # {{{1
+   """
+   Append the given tracks to the log read by __load_failures().
+   """
+   lines = []
+   for [artist, title] in tracks:
+      lines.append('\t'.join(__failure_key(artist, title)).encode('utf-8') + '\n')
+   handle = open(logfile, 'a')
+   try:
+      handle.write(''.join(lines))
+   finally:
+      handle.close()
+
 def normalize_name(string): # {{{1
    """
-   Normalize the names of artists before querying Last.fm.
+   Normalize the names of artists before querying Last.fm. The results are
+   remembered because the same names come up over and over again.
    """
-   lower = string.lower()
-   ascii = re.sub(NON_WORD_PATTERN, ' ', lower)
-   if ascii == '': ascii = lower
-   return re.sub('\s+', ' ', ascii).strip()
+   try:
+      return __NORMALIZED_NAMES[string]
+   except KeyError:
+      lower = string.lower()
+      ascii = NON_WORD_PATTERN.sub(' ', lower)
+      if ascii == '': ascii = lower
+      result = WHITESPACE_PATTERN.sub(' ', ascii).strip()
+      if len(__NORMALIZED_NAMES) >= NORMALIZED_NAMES_CACHE_SIZE:
+         __NORMALIZED_NAMES.clear()
+      __NORMALIZED_NAMES[string] = result
+      return result
 
 NON_WORD_PATTERN = re.compile('\W+', re.UNICODE)
+WHITESPACE_PATTERN = re.compile('\s+')
+NORMALIZED_NAMES_CACHE_SIZE = 50000
+__NORMALIZED_NAMES = {}
+
+def get_rate_limiter(): # {{{1
+   """
+   Get the TokenBucket that limits the rate of requests to Last.fm. It
+   allows bursts of REQUEST_BURST requests and one request per
+   SECONDS_BETWEEN_REQUESTS on average, and it's shared with all other
+   processes using the same CACHE_DIRECTORY.
+   """
+   global __RATE_LIMITER
+   if __RATE_LIMITER is None:
+      __RATE_LIMITER = TokenBucket('%s/rate limit' % CACHE_DIRECTORY,
+            SECONDS_BETWEEN_REQUESTS, REQUEST_BURST)
+   return __RATE_LIMITER
+
+class TokenBucket: # {{{1
+   """
+   Token bucket rate limiter. A token is added every interval seconds up to
+   a maximum of burst tokens and each request takes one token. The state of
+   the bucket is kept in a file which is locked while it's updated, so all
+   processes using the same file share the same budget.
+   """
+
+   def __init__(self, filename, interval, burst): # {{{2
+      self.filename = filename
+      self.interval = float(interval)
+      self.burst = burst
+      self.__lock = threading.Lock()
+
+   def try_acquire(self): # {{{2
+      """
+      Take a token when one is available without waiting. Returns True when
+      a token was taken, False otherwise.
+      """
+      return self.__take() == 0
+
+   def acquire(self, logger=None): # {{{2
+      """
+      Take a token, sleeping until one becomes available.
+      """
+      while True:
+         seconds = self.__take()
+         if seconds == 0:
+            return
+         if logger:
+            logger.debug('Sleeping for %.2f seconds before making a request', seconds)
+         time.sleep(seconds)
+
+   def __take(self): # {{{2
+      # Returns 0 when a token was taken, otherwise the number of seconds
+      # until the next token becomes available.
+      self.__lock.acquire()
+      try:
+         handle = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0666)
+         try:
+            fcntl.lockf(handle, fcntl.LOCK_EX)
+            data = os.read(handle, 16)
+            now = time.time()
+            if len(data) == 16:
+               tokens, updated = struct.unpack('dd', data)
+               tokens = min(self.burst, tokens + max(0, now - updated) / self.interval)
+            else:
+               tokens = self.burst
+            if tokens >= 1:
+               tokens -= 1
+               seconds = 0
+            else:
+               seconds = (1 - tokens) * self.interval
+            os.lseek(handle, 0, 0)
+            os.write(handle, struct.pack('dd', tokens, now))
+            return seconds
+         finally:
+            os.close(handle)
+      finally:
+         self.__lock.release()
+
+def get_circuit_breaker(): # {{{1
+   """
+   Get the CircuitBreaker that stops requests to Last.fm after
+   FAILURE_THRESHOLD consecutive failures. The first retry is made after
+   FAILURE_BACKOFF seconds and the delay doubles after every failed retry,
+   up to FAILURE_MAX_BACKOFF seconds.
+   """
+   global __CIRCUIT_BREAKER
+   if __CIRCUIT_BREAKER is None:
+      __CIRCUIT_BREAKER = CircuitBreaker(FAILURE_THRESHOLD,
+            FAILURE_BACKOFF, FAILURE_MAX_BACKOFF)
+   return __CIRCUIT_BREAKER
+
+class CircuitBreaker: # {{{1
+   """
+   Circuit breaker for requests to a web service. After threshold
+   consecutive failures the circuit is "open": allow() returns False so no
+   time is wasted on requests that will most likely time out. After backoff
+   seconds a request is allowed again; when it fails the circuit stays open
+   for twice as long (up to max_backoff seconds), when it succeeds the
+   circuit is closed again.
+   """
+
+   def __init__(self, threshold, backoff, max_backoff): # {{{2
+      self.threshold = threshold
+      self.backoff = backoff
+      self.max_backoff = max_backoff
+      self.failures = 0
+      self.retry_time = 0
+      self.__lock = threading.Lock()
+
+   def allow(self): # {{{2
+      """
+      Returns True when a request may be made, False while the circuit is open.
+      """
+      return self.failures < self.threshold or time.time() >= self.retry_time
+
+   def succeeded(self): # {{{2
+      """
+      Report a successful request, which closes the circuit.
+      """
+      self.__lock.acquire()
+      self.failures = 0
+      self.__lock.release()
+
+   def failed(self): # {{{2
+      """
+      Report a failed request. Returns the number of seconds until the next
+      retry when this opens the circuit, otherwise 0.
+      """
+      self.__lock.acquire()
+      try:
+         self.failures += 1
+         if self.failures < self.threshold:
+            return 0
+         seconds = min(self.max_backoff, self.backoff * 2 ** (self.failures - self.threshold))
+         self.retry_time = time.time() + seconds
+         return seconds
+      finally:
+         self.__lock.release()
+
+class ConnectionPool: # {{{1
+   """
+   Pool of persistent HTTP/1.1 connections, so that requests to the same
+   host reuse a connection instead of looking up the host name and setting
+   up a new TCP connection each time. Connecting times out after
+   connect_timeout seconds and waiting for data after read_timeout seconds.
+   """
+
+   MAX_REDIRECTS = 5
+
+   def __init__(self, connect_timeout, read_timeout, size=4): # {{{2
+      self.connect_timeout = connect_timeout
+      self.read_timeout = read_timeout
+      self.size = size
+      self.__idle = {}
+      self.__lock = threading.Lock()
+
+   def urlopen(self, url): # {{{2
+      """
+      Request the given URL and return a file like object for the response.
+      The connection is returned to the pool when the response has been read
+      completely and closed. Redirects are followed like urllib.urlopen()
+      does. Network errors and any other status than 2xx are raised as
+      IOError, so that error pages are never mistaken for results.
+      """
+      for redirect in range(self.MAX_REDIRECTS + 1):
+         key, connection, response = self.__request(url)
+         if response.status in (301, 302, 303, 307) and response.getheader('Location'):
+            connection.close()
+            url = urlparse.urljoin(url, response.getheader('Location'))
+            continue
+         if not 200 <= response.status < 300:
+            connection.close()
+            raise IOError('HTTP request to %s failed: %i %s' % (url, response.status, response.reason))
+         return PooledResponse(self, key, connection, response)
+      raise IOError('HTTP request to %s failed: too many redirects' % url)
+
+   def release(self, key, connection): # {{{2
+      self.__lock.acquire()
+      try:
+         connections = self.__idle.setdefault(key, [])
+         if len(connections) < self.size:
+            connections.append(connection)
+            return
+      finally:
+         self.__lock.release()
+      connection.close()
+
+   def __request(self, url): # {{{2
+      scheme, rest = urllib.splittype(url)
+      hostport, path = urllib.splithost(rest)
+      host, port = urllib.splitport(hostport)
+      key = (host, int(port or httplib.HTTP_PORT))
+      # A pooled connection may have been closed by the server in the mean
+      # time, in which case the request is retried on a new connection.
+      for attempt in (1, 2):
+         connection, reused = self.__get(key)
+         try:
+            connection.request('GET', path or '/', headers={ 'User-Agent': 'lastfm.py' })
+            return key, connection, connection.getresponse()
+         except (socket.error, httplib.HTTPException), error:
+            connection.close()
+            if not reused or attempt == 2:
+               raise IOError('HTTP request to %s failed: %s' % (url, error))
+
+   def __get(self, key): # {{{2
+      self.__lock.acquire()
+      try:
+         connections = self.__idle.get(key)
+         if connections:
+            return connections.pop(), True
+      finally:
+         self.__lock.release()
+      return self.__connect(key), False
+
+   def __connect(self, key): # {{{2
+      host, port = key
+      error = None
+      for family, socktype, proto, canonname, address in \
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+         sock = socket.socket(family, socktype, proto)
+         try:
+            sock.settimeout(self.connect_timeout)
+            sock.connect(address)
+         except socket.error, error:
+            sock.close()
+            continue
+         sock.settimeout(self.read_timeout)
+         connection = httplib.HTTPConnection(host, port)
+         connection.sock = sock
+         return connection
+      raise IOError('Failed to connect to %s:%i: %s' % (host, port, error))
+
+class PooledResponse: # {{{1
+   """
+   Response returned by ConnectionPool.urlopen().
+   """
+
+   def __init__(self, pool, key, connection, response): # {{{2
+      self.status = response.status
+      self.__pool = pool
+      self.__key = key
+      self.__connection = connection
+      self.__response = response
+
+   def read(self, amount=None): # {{{2
+      try:
+         data = self.__response.read(amount)
+      except (socket.error, httplib.HTTPException), error:
+         raise IOError('Failed to read HTTP response: %s' % error)
+      # When reading a limited amount httplib doesn't complain about a body
+      # that's shorter than its Content-Length, it just returns nothing.
+      if not data and amount and self.__response.length:
+         raise IOError('HTTP response was cut off, %i bytes are missing' % self.__response.length)
+      return data
+
+   def close(self): # {{{2
+      if self.__connection:
+         # Connections are only reused after the whole response was read.
+         if self.__response.isclosed() and not self.__response.will_close and not self.__response.length:
+            self.__pool.release(self.__key, self.__connection)
+         else:
+            self.__connection.close()
+         self.__connection = None
+
+def __urlopen(url): # {{{1
+   """
+   Open the given URL using the shared ConnectionPool.
+   """
+   global __CONNECTION_POOL
+   if __CONNECTION_POOL is None:
+      __CONNECTION_POOL = ConnectionPool(CONNECT_TIMEOUT, READ_TIMEOUT)
+   return __CONNECTION_POOL.urlopen(url)
+
+def __fetch(url, logger=None, parse=None): # {{{1
+   """
+   Download the given URL and return the decoded response, or when parse
+   is given the result of calling it with the response (so that it can be
+   processed while it arrives). Failures and successes are reported to the
+   CircuitBreaker.
+   """
+   if OFFLINE:
+      raise IOError('Not contacting Last.fm in offline mode')
+   breaker = get_circuit_breaker()
+   try:
+      handle = __urlopen(url)
+      try:
+         if parse:
+            data = parse(handle)
+         else:
+            data = handle.read().decode('utf-8')
+      finally:
+         handle.close()
+   except (IOError, socket.error):
+      seconds = breaker.failed()
+      if seconds and logger:
+         logger.warning('Last.fm failed %i times in a row, not trying again for %i seconds',
+               breaker.failures, seconds)
+      raise
+   breaker.succeeded()
+   return data
+
+def __parse_similar_artists(handle, artist_key, limit): # {{{1
+   """
+   Parse a similar.txt response from Last.fm while it's being received. Each
+   line contains the similarity, the UUID and the name of an artist. Only
+   the first limit artists are parsed, the rest is read but ignored so that
+   the connection can be reused. Returns a list of dictionaries like
+   get_similar_artists().
+   """
+   results = []
+   partial = ''
+   while True:
+      data = handle.read(SIMILAR_ARTISTS_READ_SIZE)
+      if len(results) >= limit:
+         if not data:
+            break
+         continue
+      lines = (partial + data).split('\n')
+      partial = data and lines.pop() or ''
+      for line in lines:
+         record = line.split(',', 2)
+         if len(record) == 3:
+            similarity, uuid, similar_artist = record
+            similar_artist = similar_artist.decode('utf-8')
+            if '&' in similar_artist:
+               similar_artist = __htmlentitydecode(similar_artist)
+            similar_key = normalize_name(similar_artist)
+            if similar_key != artist_key:
+               results.append({ 'similarity': float(similarity), 'uuid': uuid, \
+                     'name': similar_artist, 'key': similar_key })
+               if len(results) >= limit:
+                  break
+      if not data:
+         break
+   results.sort(key=operator.itemgetter('similarity'), reverse=True)
+   return results
+
+def __get_similar_artists_cache(): # {{{1
+   """
+   Get the SimilarArtistsCache used by get_similar_artists(), or None when
+   caching isn't possible because the sqlite3 module isn't available.
+   """
+   global __SIMILAR_ARTISTS_CACHE
+   if __SIMILAR_ARTISTS_CACHE is None and sqlite3:
+      __SIMILAR_ARTISTS_CACHE = SimilarArtistsCache('%s/similar artists.sqlite' % CACHE_DIRECTORY,
+            SIMILAR_ARTISTS_TTL, SIMILAR_ARTISTS_CACHE_SIZE)
+   return __SIMILAR_ARTISTS_CACHE
 
 def __sleep(logger=None): # {{{1
    """
-   Use time.sleep() to enforce a reasonable time
-   between requests to the Last.fm web services.
+   Use time.sleep() to enforce a reasonable rate of
+   requests to the Last.fm web services.
    """
-   global __LAST_REQUEST_TIME
-   elapsed = time.time() - __LAST_REQUEST_TIME
-   if elapsed < SECONDS_BETWEEN_REQUESTS:
-      seconds = SECONDS_BETWEEN_REQUESTS - elapsed
-      if logger:
-         logger.debug('Sleeping for %.2f seconds before making a request', seconds)
-      time.sleep(seconds)
-   __LAST_REQUEST_TIME = time.time()
+   get_rate_limiter().acquire(logger)
+
+def __artist_graph_fname(): # {{{1
+   return '%s/artist graph.marshal' % CACHE_DIRECTORY
+
+def __failure_key(artist, title): # {{{1
+   # Tracks are logged as unicode strings without tabs and newlines.
+   key = []
+   for field in (artist, title):
+      if isinstance(field, str):
+         field = field.decode('utf-8')
+      key.append(re.sub('[\t\n]', ' ', field))
+   return tuple(key)
 
 def __cached_tracks_fname(username, type): # {{{1
-   return '%s/%s by %s' % (CACHE_DIRECTORY, type, username)
+   return '%s/%s by %s.marshal' % (CACHE_DIRECTORY, type, username)
 
 def __cached_failures_fname(username, action): # {{{1
-   return '%s/failed to %s for %s' % (CACHE_DIRECTORY, action, username)
+   return '%s/failed to %s for %s.log' % (CACHE_DIRECTORY, action, username)
+
+def __cached_session_key_fname(username): # {{{1
+   return '%s/session key for %s.marshal' % (CACHE_DIRECTORY, username)
 
 def __htmlentitydecode(string): # {{{1
    """ Replace HTML entities with the characters they represent. """
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# vim: et ts=3 sw=3 fdm=marker fdl=1 encoding=utf-8
+
+"""
+This module implements a local stub of the parts of the Last.fm web service
+used by the lastfm module, so that rate limiting, caching and retries can be
+exercised and benchmarked without the real web service. The stub serves
+artist/*/similar.txt and the user/*/library/loved and banned pages from
+fixture data and can inject latency, server errors, truncated responses and
+throttling. When run as a script it starts the stub and runs a benchmark of
+lastfm.get_similar_artists() and lastfm.get_loved_tracks() against it:
+
+   $ python lastfmstub.py --latency 50 --errors 0.05 --requests 200
+
+With --connect-latency the stub also delays every new connection, which shows
+what reusing connections saves.
+
+With --parser it compares the parser of similar.txt responses in the lastfm
+module with the one it replaced, on recorded responses given as arguments
+(or on responses generated from the fixtures when there are none):
+
+   $ python lastfmstub.py --parser similar/*.txt
+
+Use --serve to only run the stub, e.g. to point mpd-myfm at it by setting
+lastfm.SIMILAR_ARTISTS_URL and lastfm.LIBRARY_URL.
+"""
+
+import BaseHTTPServer
+import cgi
+import optparse
+import random
+import re
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+
+TRACKS_PER_PAGE = 50
+
+def main(): # {{{1
+   parser = optparse.OptionParser(usage='%prog [OPTIONS]')
+   parser.add_option('--port', type='int', default=0, help='port to listen on (default: any free port)')
+   parser.add_option('--serve', action='store_true', default=False, help="only run the stub server, don't run the benchmark")
+   parser.add_option('--similar', metavar='FILE', help='fixture with similar artists, in the format of lastfm.import_similar_artists() (default: generated)')
+   parser.add_option('--artists', type='int', default=1000, help='number of generated artists (%default)')
+   parser.add_option('--tracks', type='int', default=500, help='number of loved and banned tracks per user (%default)')
+   parser.add_option('--latency', type='float', default=0, metavar='MS', help='average latency of responses in milliseconds (%default)')
+   parser.add_option('--connect-latency', type='float', default=0, dest='connect_latency', metavar='MS', help='delay before a new connection is served in milliseconds, e.g. a round trip for the handshake (%default)')
+   parser.add_option('--errors', type='float', default=0, metavar='FRACTION', help='fraction of requests answered with 503 Service Unavailable (%default)')
+   parser.add_option('--truncate', type='float', default=0, metavar='FRACTION', help='fraction of responses that are cut off halfway (%default)')
+   parser.add_option('--throttle', type='float', default=0, metavar='NUM', help='answer with 503 when more than this many requests per second are made (default: no limit)')
+   parser.add_option('--requests', type='int', default=100, help='number of similar artists to look up (%default)')
+   parser.add_option('--interval', type='float', default=0.01, metavar='SEC', help='lastfm.SECONDS_BETWEEN_REQUESTS during the benchmark (%default)')
+   parser.add_option('--burst', type='int', default=10, help='lastfm.REQUEST_BURST during the benchmark (%default)')
+   parser.add_option('--parser', action='store_true', default=False, help='benchmark the parser of similar.txt responses on the recorded responses in the given files instead')
+   options, arguments = parser.parse_args()
+   if options.similar:
+      fixtures = Fixtures.load(options.similar, options.tracks)
+   else:
+      fixtures = Fixtures.generate(options.artists, options.tracks)
+   if options.parser:
+      if arguments:
+         bodies = [open(filename, 'rb').read() for filename in arguments]
+      else:
+         bodies = [fixtures.similar_artists(key, 100) for key in sorted(fixtures.similar)[:options.requests]]
+      benchmarkparser(bodies)
+      return
+   server = StubServer(('127.0.0.1', options.port), fixtures)
+   server.latency = options.latency / 1000.0
+   server.connect_latency = options.connect_latency / 1000.0
+   server.error_rate = options.errors
+   server.truncate_rate = options.truncate
+   server.throttle = options.throttle
+   if options.serve:
+      print 'Serving %i artists on %s' % (len(fixtures.similar), server.url)
+      print 'lastfm.SIMILAR_ARTISTS_URL = %r' % server.similar_artists_url
+      print 'lastfm.LIBRARY_URL = %r' % server.library_url
+      server.serve_forever()
+   else:
+      server.start()
+      try:
+         benchmark(server, fixtures, options)
+      finally:
+         server.shutdown()
+
+def benchmark(server, fixtures, options): # {{{1
+   """
+   Run get_similar_artists() and get_loved_tracks() against the given stub
+   server with an empty cache directory and print the throughput, latency
+   percentiles and errors. Then compare requests over a new connection each
+   time with requests through the connection pool of the lastfm module.
+   """
+   import lastfm
+   directory = tempfile.mkdtemp(prefix='lastfmstub-')
+   try:
+      lastfm.CACHE_DIRECTORY = directory
+      lastfm.SIMILAR_ARTISTS_URL = server.similar_artists_url
+      lastfm.LIBRARY_URL = server.library_url
+      lastfm.SECONDS_BETWEEN_REQUESTS = options.interval
+      lastfm.REQUEST_BURST = options.burst
+      artists = fixtures.artists()
+      random.shuffle(artists)
+      lookups = [artists[i % len(artists)] for i in xrange(options.requests)]
+      report('get_similar_artists() (cache misses)', server,
+            measure(lambda artist: lastfm.get_similar_artists(artist), lookups))
+      report('get_similar_artists() (cache hits)', server,
+            measure(lambda artist: lastfm.get_similar_artists(artist), lookups))
+      report('get_loved_tracks() (%i tracks)' % options.tracks, server,
+            measure(lambda username: lastfm.get_loved_tracks(username), ['stub']))
+      # Compare a new connection per request with the connection pool.
+      url = server.similar_artists_url % ('artist%201', 100)
+      pool = lastfm.ConnectionPool(lastfm.CONNECT_TIMEOUT, lastfm.READ_TIMEOUT)
+      for title, urlopen in (('urllib.urlopen()', urllib.urlopen), ('lastfm.ConnectionPool', pool.urlopen)):
+         report('%s (%i requests)' % (title, options.requests), server,
+               measure(lambda url: fetch(urlopen, url), [url] * options.requests))
+   finally:
+      shutil.rmtree(directory)
+
+def benchmarkparser(bodies, repeat=20): # {{{1
+   """
+   Parse the given similar.txt responses with the parser that read the whole
+   response before parsing it and with lastfm.__parse_similar_artists() and
+   print the CPU time per response. Then check that both give the same
+   results, apart from the artists with a comma in their name which the
+   old parser dropped.
+   """
+   import lastfm
+   import StringIO
+   parsers = (('whole response', parsesimilarartists, False), ('while it arrives, cold name cache', lastfm.__parse_similar_artists, True),
+         ('while it arrives, warm name cache', lastfm.__parse_similar_artists, False))
+   for title, parse, cold in parsers:
+      elapsed = None
+      for i in xrange(repeat):
+         if cold:
+            lastfm.__NORMALIZED_NAMES.clear()
+         handles = [StringIO.StringIO(body) for body in bodies]
+         started = time.clock()
+         for handle in handles:
+            parse(handle, u'', 100)
+         elapsed = min(elapsed or 1e9, time.clock() - started)
+      print '%s: %.0f us per response' % (title, elapsed / len(bodies) * 1e6)
+   differences = 0
+   for body in bodies:
+      old = [(r['similarity'], r['name'], r['key']) for r in parsesimilarartists(StringIO.StringIO(body), u'', 100)]
+      new = [(r['similarity'], r['name'], r['key']) for r in lastfm.__parse_similar_artists(StringIO.StringIO(body), u'', 100) if ',' not in r['name']]
+      if old != new:
+         differences += 1
+   print '%i responses, %i with different results' % (len(bodies), differences)
+
+def parsesimilarartists(handle, artist_key, limit): # {{{1
+   # The parser used before similar.txt responses were parsed while they
+   # arrive, as the baseline. It read the whole response and ignored limit.
+   import lastfm
+   def normalize(string):
+      lower = string.lower()
+      ascii = re.sub(lastfm.NON_WORD_PATTERN, ' ', lower)
+      if ascii == '': ascii = lower
+      return re.sub('\s+', ' ', ascii).strip()
+   results = []
+   for record in [line.split(",") for line in handle.read().decode('utf-8').split('\n')]:
+      if len(record) == 3:
+         similarity, uuid, similar_artist = record
+         similar_artist = lastfm.__htmlentitydecode(similar_artist)
+         similar_key = normalize(similar_artist)
+         if similar_key != artist_key:
+            results.append({ 'similarity': float(similarity), 'uuid': uuid, \
+                  'name': similar_artist, 'key': similar_key })
+   results.sort(lambda x, y: -cmp(x['similarity'], y['similarity']))
+   return results
+
+def fetch(urlopen, url): # {{{1
+   handle = urlopen(url)
+   try:
+      handle.read()
+   finally:
+      handle.close()
+
+def measure(function, arguments): # {{{1
+   """
+   Call function with each of the arguments. Returns a tuple with the total
+   time, the times of the successful calls and the number of failed calls.
+   """
+   timings = []
+   failures = 0
+   started = time.time()
+   for argument in arguments:
+      before = time.time()
+      try:
+         function(argument)
+         timings.append(time.time() - before)
+      except IOError:
+         failures += 1
+   return time.time() - started, timings, failures
+
+def report(title, server, measurement): # {{{1
+   total, timings, failures = measurement
+   requests = server.reset_statistics()
+   print '%s:' % title
+   print '   %i calls in %.2f seconds (%.1f calls/second), %i failed' % (len(timings) + failures,
+         total, (len(timings) + failures) / max(total, 0.001), failures)
+   if timings:
+      timings.sort()
+      print '   latency: p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms' % (percentile(timings, 50) * 1000,
+            percentile(timings, 90) * 1000, percentile(timings, 99) * 1000, timings[-1] * 1000)
+   print '   stub server: %(requests)i requests, %(errors)i errors, %(truncated)i truncated, %(throttled)i throttled' % requests
+
+def percentile(values, percent): # {{{1
+   # The values should be sorted.
+   return values[int(round((len(values) - 1) * percent / 100.0))]
+
+class Fixtures: # {{{1
+   """
+   The data served by the stub server: a dictionary with the similar artists
+   of each artist (lists of (similarity, name) tuples from most to least
+   similar) and the loved and banned tracks of every user (lists of (artist,
+   title) tuples from newest to oldest).
+   """
+
+   def __init__(self, similar, tracks): # {{{2
+      self.similar = similar
+      self.tracks = tracks
+
+   def generate(cls, artists, tracks): # {{{2
+      """
+      Generate fixtures for the given number of artists with 100 similar
+      artists each (the same every time) and the given number of loved and
+      banned tracks for any user. Some names contain HTML entities, commas
+      and non-ASCII characters.
+      """
+      generator = random.Random(42)
+      names = ['Artist %i' % i for i in xrange(artists)]
+      for i in xrange(0, artists, 7):
+         names[i] = generator.choice([u'Caf\xe9 %i', 'Sun &amp; Moon %i', 'Crosby, Stills &amp; Nash %i']) % i
+      similar = {}
+      for name in names:
+         others = generator.sample(names, min(100, len(names)))
+         similar[cls.key(name)] = [(round(100.0 - i * 0.9, 2), other) for (i, other) in enumerate(others) if other != name]
+      lovedtracks = [(generator.choice(names), 'Title %i' % i) for i in xrange(tracks)]
+      return cls(similar, { 'loved': lovedtracks, 'banned': lovedtracks[:tracks / 10] })
+   generate = classmethod(generate)
+
+   def load(cls, filename, tracks): # {{{2
+      """
+      Load similar artists from a file in the format read by
+      lastfm.import_similar_artists() and generate the given number of loved
+      and banned tracks by those artists.
+      """
+      similar = {}
+      handle = open(filename, 'r')
+      try:
+         for line in handle:
+            line = line.decode('utf-8').rstrip('\r\n')
+            fields = line.split('\t')
+            if not line.startswith('#') and len(fields) == 3:
+               similar.setdefault(cls.key(fields[0]), []).append((float(fields[2]), cgi.escape(fields[1])))
+      finally:
+         handle.close()
+      for records in similar.values():
+         records.sort(reverse=True)
+      names = [name for records in similar.values() for (similarity, name) in records]
+      lovedtracks = [(random.choice(names), 'Title %i' % i) for i in xrange(tracks)]
+      return cls(similar, { 'loved': lovedtracks, 'banned': lovedtracks[:tracks / 10] })
+   load = classmethod(load)
+
+   def key(name): # {{{2
+      # Requests contain normalized artist names.
+      import lastfm
+      return lastfm.normalize_name(name.replace('&amp;', '&'))
+   key = staticmethod(key)
+
+   def artists(self): # {{{2
+      """
+      Get the names of the artists in the fixtures.
+      """
+      names = {}
+      for records in self.similar.itervalues():
+         for (similarity, name) in records:
+            names[name.replace('&amp;', '&')] = True
+      return [name for name in names if self.key(name) in self.similar]
+
+   def similar_artists(self, key, limit): # {{{2
+      lines = ['%.2f,%08x-0000-0000-0000-000000000000,%s\n' % (similarity, i, name)
+            for (i, (similarity, name)) in enumerate(self.similar.get(key, [])[:limit])]
+      return u''.join(lines).encode('utf-8')
+
+   def library_page(self, type, pagenr): # {{{2
+      tracks = self.tracks.get(type, [])
+      lastpage = max(1, (len(tracks) + TRACKS_PER_PAGE - 1) / TRACKS_PER_PAGE)
+      rows = []
+      for (artist, title) in tracks[(pagenr - 1) * TRACKS_PER_PAGE:pagenr * TRACKS_PER_PAGE]:
+         rows.append('<tr><td class="subjectCell">\n<a href="/music/a">%s</a> \xe2\x80\x93 <a href="/music/a/_/t">%s</a>\n</td></tr>\n'
+               % (cgi.escape(artist).encode('utf-8'), cgi.escape(title).encode('utf-8')))
+      return '<html><body><table>\n%s</table>\n<a href="?page=%i" class="lastpage">%i</a></body></html>\n' \
+            % (''.join(rows), lastpage, lastpage)
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer): # {{{1
+   """
+   Threaded HTTP/1.1 server that answers requests for the given Fixtures.
+   Faults are injected according to the following attributes:
+
+    * latency: average delay in seconds before a response is sent (the
+      actual delay is uniformly distributed between 0.5 and 1.5 times this),
+    * connect_latency: delay in seconds before a new connection is served,
+    * error_rate: fraction of requests answered with 503 Service Unavailable,
+    * truncate_rate: fraction of responses whose body is cut off halfway
+      after which the connection is closed,
+    * throttle: maximum number of requests per second, requests above this
+      rate are answered with 503 Service Unavailable (0 means no limit).
+   """
+
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, address, fixtures): # {{{2
+      BaseHTTPServer.HTTPServer.__init__(self, address, StubRequestHandler)
+      self.fixtures = fixtures
+      self.latency = 0
+      self.connect_latency = 0
+      self.error_rate = 0
+      self.truncate_rate = 0
+      self.throttle = 0
+      self.url = 'http://%s:%i' % self.server_address
+      self.similar_artists_url = self.url + '/2.0/artist/%s/similar.txt?limit=%i'
+      self.library_url = self.url + '/user/%s/library/%s?page=%i'
+      self.__lock = threading.Lock()
+      self.__recent = []
+      self.__thread = None
+      # Connections that are being handled, so they can be closed on shutdown.
+      self.__connections = {}
+      self.__closed = threading.Condition(self.__lock)
+      self.reset_statistics()
+
+   def start(self): # {{{2
+      """
+      Start serving requests in a background thread.
+      """
+      self.__thread = threading.Thread(target=self.serve_forever)
+      self.__thread.setDaemon(True)
+      self.__thread.start()
+
+   def shutdown(self): # {{{2
+      """
+      Stop serving requests and close all connections.
+      """
+      if self.__thread:
+         BaseHTTPServer.HTTPServer.shutdown(self)
+         self.__thread = None
+      self.server_close()
+      self.__lock.acquire()
+      try:
+         for connection in self.__connections.keys():
+            try:
+               connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+               pass
+         # Give the threads handling them a moment to finish.
+         deadline = time.time() + 1
+         while self.__connections and time.time() < deadline:
+            self.__closed.wait(deadline - time.time())
+      finally:
+         self.__lock.release()
+
+   def register(self, connection, active): # {{{2
+      # Called by StubRequestHandler when a connection is opened and closed.
+      self.__lock.acquire()
+      try:
+         if active:
+            self.__connections[connection] = True
+         else:
+            self.__connections.pop(connection, None)
+            self.__closed.notifyAll()
+      finally:
+         self.__lock.release()
+
+   def handle_error(self, request, client_address): # {{{2
+      # Clients closing their connection while the stub is waiting for the
+      # next request is business as usual.
+      pass
+
+   def reset_statistics(self): # {{{2
+      """
+      Reset the request counters and return their previous values.
+      """
+      self.__lock.acquire()
+      try:
+         previous = getattr(self, 'statistics', None)
+         self.statistics = { 'requests': 0, 'errors': 0, 'truncated': 0, 'throttled': 0 }
+         return previous
+      finally:
+         self.__lock.release()
+
+   def fault(self): # {{{2
+      """
+      Count a request and decide which fault to inject for it, if any.
+      Returns 'throttled', 'errors', 'truncated' or None.
+      """
+      self.__lock.acquire()
+      try:
+         self.statistics['requests'] += 1
+         fault = None
+         if self.throttle:
+            now = time.time()
+            self.__recent = [t for t in self.__recent if now - t < 1] + [now]
+            if len(self.__recent) > self.throttle:
+               fault = 'throttled'
+         if not fault and random.random() < self.error_rate:
+            fault = 'errors'
+         elif not fault and random.random() < self.truncate_rate:
+            fault = 'truncated'
+         if fault:
+            self.statistics[fault] += 1
+         return fault
+      finally:
+         self.__lock.release()
+
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler): # {{{1
+
+   protocol_version = 'HTTP/1.1'
+   # Send the headers and body in one go instead of one write per line,
+   # otherwise Nagle's algorithm adds a delay to every response.
+   wbufsize = -1
+   similar_pattern = re.compile('^/2\.0/artist/([^/]+)/similar\.txt\?limit=(\d+)$')
+   library_pattern = re.compile('^/user/[^/]+/library/(loved|banned)\?page=(\d+)$')
+
+   def setup(self): # {{{2
+      if self.server.connect_latency:
+         time.sleep(self.server.connect_latency)
+      BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+      self.server.register(self.connection, True)
+
+   def finish(self): # {{{2
+      try:
+         BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+      finally:
+         self.server.register(self.connection, False)
+
+   def do_GET(self): # {{{2
+      server = self.server
+      if server.latency:
+         time.sleep(server.latency * random.uniform(0.5, 1.5))
+      fault = server.fault()
+      if fault in ('errors', 'throttled'):
+         self.respond(503, 'Service Temporarily Unavailable\n')
+         return
+      match = self.similar_pattern.match(self.path)
+      if match:
+         key = urllib.unquote(match.group(1)).decode('utf-8')
+         body = server.fixtures.similar_artists(key, int(match.group(2)))
+         self.respond(200, body, 'text/plain; charset=utf-8', fault == 'truncated')
+         return
+      match = self.library_pattern.match(self.path)
+      if match:
+         body = server.fixtures.library_page(match.group(1), int(match.group(2)))
+         self.respond(200, body, 'text/html; charset=utf-8', fault == 'truncated')
+         return
+      self.respond(404, 'Not Found\n')
+
+   def respond(self, status, body, contenttype='text/plain', truncate=False): # {{{2
+      self.send_response(status)
+      self.send_header('Content-Type', contenttype)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      if truncate:
+         body = body[:len(body) / 2]
+         self.close_connection = 1
+      self.wfile.write(body)
+
+   def log_message(self, format, *args): # {{{2
+      pass
+
+if __name__ == '__main__':
+   main()
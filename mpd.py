@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import socket
 
 
@@ -22,6 +23,7 @@ ERROR_PREFIX = "ACK "
 SUCCESS = "OK"
 NEXT = "list_OK"
 PROTOCOL_ENCODING = "UTF-8"
+READ_SIZE = 65536
 
 
 class MPDError(Exception):
@@ -39,6 +41,9 @@ class CommandError(MPDError):
 class CommandListError(MPDError):
     pass
 
+class PendingCommandError(MPDError):
+    pass
+
 
 class _NotConnected(object):
     def __getattr__(self, attr):
@@ -47,9 +52,67 @@ class _NotConnected(object):
     def _dummy(*args):
         raise ConnectionError("Not connected")
 
+class _SocketReader(object):
+    """
+    Buffered reader for the responses of MPD. Data is received from the
+    socket in large blocks which are split into lines all at once, so that
+    large responses can be parsed a block of lines at a time.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._partial = ""
+        # Complete lines that haven't been consumed yet, in reverse order.
+        self._lines = []
+
+    def _fill(self):
+        while True:
+            try:
+                data = self._sock.recv(READ_SIZE)
+                break
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        if not data:
+            return False
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        lines.reverse()
+        self._lines = lines
+        return True
+
+    def readline(self):
+        while not self._lines:
+            if not self._fill():
+                line, self._partial = self._partial, ""
+                return line
+        return self._lines.pop() + "\n"
+
+    def readlines(self):
+        while not self._lines:
+            if not self._fill():
+                raise ConnectionError("Connection lost while reading line")
+        lines = self._lines
+        lines.reverse()
+        self._lines = []
+        return lines
+
+    def unreadlines(self, lines):
+        lines = list(lines)
+        lines.reverse()
+        self._lines.extend(lines)
+
+    def close(self):
+        self._partial = ""
+        self._lines = []
+
 class MPDClient(object):
     def __init__(self):
         self.iterate = False
+        # When set to a list of (lower case) tags, objects returned by
+        # commands only contain those tags, which saves decoding the others.
+        self.fields = None
+        self._keys = {}
         self._reset()
         self._commands = {
             # Admin Commands
@@ -65,6 +128,7 @@ class MPDClient(object):
             "notcommands":      self._getlist,
             "tagtypes":         self._getlist,
             "urlhandlers":      self._getlist,
+            "idle":             self._getlist,
             # Database Commands
             "find":             self._getsongs,
             "list":             self._getlist,
@@ -124,14 +188,27 @@ class MPDClient(object):
         }
 
     def __getattr__(self, attr):
+        # Besides calling a command and waiting for its response, commands
+        # can be sent with send_<command>() and their response read later
+        # with fetch_<command>(), e.g. after select() reported that the
+        # response of send_idle() arrived.
+        if attr.startswith("send_"):
+            command, wrapper = attr[len("send_"):], self._send
+        elif attr.startswith("fetch_"):
+            command, wrapper = attr[len("fetch_"):], self._fetch
+        else:
+            command, wrapper = attr, self._docommand
         try:
-            retval = self._commands[attr]
+            retval = self._commands[command]
         except KeyError:
             raise AttributeError("'%s' object has no attribute '%s'" %
                                  (self.__class__.__name__, attr))
-        return lambda *args: self._docommand(attr, args, retval)
+        return lambda *args: wrapper(command, args, retval)
 
     def _docommand(self, command, args, retval):
+        if self._pending:
+            raise PendingCommandError("Cannot execute %s with pending "
+                                      "commands" % command)
         if self._commandlist is not None and not callable(retval):
             raise CommandListError("%s not allowed in command list" % command)
         self._writecommand(command, args)
@@ -141,11 +218,36 @@ class MPDClient(object):
             return retval
         self._commandlist.append(retval)
 
+    def _send(self, command, args, retval):
+        if self._commandlist is not None:
+            raise CommandListError("Cannot use send_%s in a command list" %
+                                   command)
+        self._writecommand(command, args)
+        if retval is not None:
+            self._pending.append(command)
+
+    def _fetch(self, command, args, retval):
+        if self._commandlist is not None:
+            raise CommandListError("Cannot use fetch_%s in a command list" %
+                                   command)
+        if not self._pending:
+            raise PendingCommandError("No pending commands to fetch")
+        if self._pending[0] != command:
+            raise PendingCommandError("'%s' is not the currently pending "
+                                      "command" % command)
+        del self._pending[0]
+        if callable(retval):
+            return retval()
+        return retval
+
     def _writeline(self, line):
         self._wfile.write("%s\n" % line)
         self._wfile.flush()
 
     def _writecommand(self, command, args=[]):
+        self._writeline(self._formatcommand(command, args))
+
+    def _formatcommand(self, command, args=[]):
         parts = [command]
         for arg in args:
             if isinstance(arg, unicode):
@@ -153,7 +255,7 @@ class MPDClient(object):
             elif not isinstance(arg, str):
                 arg = str(arg)
             parts.append('"%s"' % escape(arg))
-        self._writeline(" ".join(parts))
+        return " ".join(parts)
 
     def _readline(self):
         line = self._rfile.readline().decode(PROTOCOL_ENCODING)
@@ -205,27 +307,57 @@ class MPDClient(object):
         raise StopIteration
 
     def _readobjects(self, delimiters=[]):
+        # This is where the bulk of large responses like "listallinfo" gets
+        # parsed, so instead of reading single lines with _readitem() the
+        # lines are processed a block at a time and only the values that are
+        # kept are decoded. Lines that don't look like items are handed to
+        # _readline() which knows how to deal with the end of a response.
+        keys = self._keys
+        fields = self.fields
+        if fields is not None:
+            fields = dict.fromkeys(list(fields) + list(delimiters))
+        delimiters = dict.fromkeys(delimiters)
         obj = {}
-        for key, value in self._readitems():
-            key = key.lower()
-            if obj:
-                if key in delimiters:
-                    yield obj
-                    obj = {}
-                elif obj.has_key(key):
-                    if not isinstance(obj[key], list):
-                        obj[key] = [obj[key], value]
-                    else:
-                        obj[key].append(value)
+        while True:
+            lines = self._rfile.readlines()
+            for position in xrange(len(lines)):
+                line = lines[position]
+                key, separator, value = line.partition(": ")
+                try:
+                    key = keys[key]
+                except KeyError:
+                    if not separator or line.startswith(ERROR_PREFIX):
+                        self._rfile.unreadlines(lines[position:])
+                        line = self._readline()
+                        if line is None:
+                            if obj:
+                                yield obj
+                            raise StopIteration
+                        raise ProtocolError("Could not parse item: '%s'" % line)
+                    keys[key] = key = key.decode(PROTOCOL_ENCODING).lower()
+                if fields is not None and key not in fields:
                     continue
-            obj[key] = value
-        if obj:
-            yield obj
-        raise StopIteration
+                value = value.decode(PROTOCOL_ENCODING)
+                if obj:
+                    if key in delimiters:
+                        yield obj
+                        obj = {}
+                    elif key in obj:
+                        if not isinstance(obj[key], list):
+                            obj[key] = [obj[key], value]
+                        else:
+                            obj[key].append(value)
+                        continue
+                obj[key] = value
 
     def _readcommandlist(self):
-        for retval in self._commandlist:
-            yield retval()
+        try:
+            for retval in self._commandlist:
+                yield retval()
+        except CommandError:
+            # MPD stops executing the command list after an error.
+            self._commandlist = None
+            raise
         self._commandlist = None
         self._getnone()
         raise StopIteration
@@ -288,6 +420,7 @@ class MPDClient(object):
     def _reset(self):
         self.mpd_version = None
         self._commandlist = None
+        self._pending = []
         self._sock = None
         self._rfile = _NotConnected()
         self._wfile = _NotConnected()
@@ -315,7 +448,7 @@ class MPDClient(object):
             break
         if not self._sock:
             raise socket.error(msg)
-        self._rfile = self._sock.makefile("rb")
+        self._rfile = _SocketReader(self._sock)
         self._wfile = self._sock.makefile("wb")
         try:
             self._hello()
@@ -329,6 +462,23 @@ class MPDClient(object):
         self._sock.close()
         self._reset()
 
+    def fileno(self):
+        if not self._sock:
+            raise ConnectionError("Not connected")
+        return self._sock.fileno()
+
+    def noidle(self):
+        """
+        Cancel the "idle" command sent by send_idle() and return the
+        subsystems that changed in the mean time (if any).
+        """
+        if not self._pending or self._pending[0] != "idle":
+            raise PendingCommandError("Cannot send noidle if send_idle was "
+                                      "not called")
+        del self._pending[0]
+        self._writecommand("noidle")
+        return self._getlist()
+
     def command_list_ok_begin(self):
         if self._commandlist is not None:
             raise CommandListError("Already in command list")
@@ -341,6 +491,129 @@ class MPDClient(object):
         self._writecommand("command_list_end")
         return self._getcommandlist()
 
+    def batch(self):
+        """
+        Start a batch of commands that are sent to MPD in a single command
+        list with a single write when the batch is sent, so that they take a
+        single round trip. Commands called on the batch return a
+        CommandResult whose result() is available after the batch was sent:
+
+            with client.batch() as batch:
+                status = batch.status()
+                songs = batch.playlistinfo()
+            print status.result(), songs.result()
+        """
+        return CommandBatch(self)
+
+    def _sendbatch(self, commands):
+        if self._pending:
+            raise PendingCommandError("Cannot send a batch with pending "
+                                      "commands")
+        if self._commandlist is not None:
+            raise CommandListError("Already in command list")
+        lines = ["command_list_ok_begin"]
+        for command, args, retval, result in commands:
+            lines.append(self._formatcommand(command, args))
+        lines.append("command_list_end")
+        self._wfile.write("\n".join(lines) + "\n")
+        self._wfile.flush()
+        # Each response has to be read completely before the next one, so
+        # results are never returned as iterators here.
+        iterate, self.iterate = self.iterate, False
+        self._commandlist = []
+        try:
+            for command, args, retval, result in commands:
+                try:
+                    result._set(retval())
+                except CommandError, e:
+                    # MPD stops executing the command list after an error.
+                    self._commandlist = None
+                    result._fail(e)
+                    for skipped in commands:
+                        if not skipped[3].done():
+                            skipped[3]._fail(CommandError(
+                                "%s not executed because of an earlier "
+                                "error" % skipped[0]))
+                    raise
+            self._commandlist = None
+            self._getnone()
+        finally:
+            self.iterate = iterate
+            self._commandlist = None
+
+
+class CommandResult(object):
+    """
+    Result of a command in a CommandBatch, which is available after the
+    batch was sent.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise CommandListError("%s has not been sent yet" % self.command)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _set(self, value):
+        self._done = True
+        self._value = value
+
+    def _fail(self, error):
+        self._done = True
+        self._error = error
+
+class CommandBatch(object):
+    """
+    Commands queued with MPDClient.batch(). The batch is sent by send(), or
+    at the end of a with statement unless that ended with an exception.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, attr):
+        try:
+            retval = self._client._commands[attr]
+        except KeyError:
+            raise AttributeError("'%s' object has no attribute '%s'" %
+                                 (self.__class__.__name__, attr))
+        return lambda *args: self._queue(attr, args, retval)
+
+    def _queue(self, command, args, retval):
+        if not callable(retval):
+            raise CommandListError("%s not allowed in command list" % command)
+        result = CommandResult(command)
+        self._commands.append((command, args, retval, result))
+        return result
+
+    def __len__(self):
+        return len(self._commands)
+
+    def send(self):
+        commands, self._commands = self._commands, []
+        if commands:
+            self._client._sendbatch(commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.send()
+        else:
+            self._commands = []
+
 
 def escape(text):
     return text.replace("\\", "\\\\").replace('"', '\\"')
@@ -0,0 +1,655 @@
+#!/usr/bin/env python
+# vim: et ts=3 sw=3 fdm=marker fdl=1 encoding=utf-8
+
+"""
+This module implements a local stub of the Music Player Daemon, so that the
+mpd module and mpd-myfm can be benchmarked without a real MPD server and a
+large music library. The stub serves a generated library and play list and
+understands the commands used by mpd-myfm, including command lists and
+idle. Every response can be delayed to simulate the round trip to a remote
+server. When run as a script it starts the stub and runs benchmarks of the
+mpd module against it:
+
+   $ python mpdstub.py --tracks 100000 --latency 20
+
+With --myfm it runs the main loop of mpd-myfm against the stub and the Last.fm
+stub (see lastfmstub.py) instead, skips to the last track in the play list
+at random moments and presses remote control buttons in the mean time. It
+reports how long it takes to add a track and to handle a button:
+
+   $ python mpdstub.py --myfm --tracks 20000 --lastfm-latency 500
+
+With --memory it reports how much memory the library index of mpd-myfm
+takes, compared with keeping the dictionaries returned by listallinfo
+(Linux only):
+
+   $ python mpdstub.py --memory --tracks 200000
+
+Use --serve to only run the stub, e.g. to point mpd-myfm at it.
+"""
+
+from __future__ import with_statement
+import gc
+import optparse
+import os
+import random
+import select
+import shlex
+import socket
+import SocketServer
+import threading
+import time
+
+def main(): # {{{1
+   parser = optparse.OptionParser(usage='%prog [OPTIONS]')
+   parser.add_option('--port', type='int', default=0, help='port to listen on (default: any free port)')
+   parser.add_option('--serve', action='store_true', default=False, help="only run the stub server, don't run the benchmarks")
+   parser.add_option('--tracks', type='int', default=100000, help='number of tracks in the generated library (%default)')
+   parser.add_option('--latency', type='float', default=0, metavar='MS', help='delay before each response in milliseconds (%default)')
+   parser.add_option('--repeat', type='int', default=3, help='number of times each benchmark is repeated, the best time is reported (%default)')
+   parser.add_option('--myfm', action='store_true', default=False, help='benchmark the main loop of mpd-myfm instead of the mpd module')
+   parser.add_option('--lastfm-latency', type='float', default=500, dest='lastfm_latency', metavar='MS', help='average latency of the Last.fm stub in milliseconds, with --myfm (%default)')
+   parser.add_option('--picks', type='int', default=20, help='number of times to skip to the last track, with --myfm (%default)')
+   parser.add_option('--memory', action='store_true', default=False, help='report the memory used by the library index of mpd-myfm instead')
+   options, arguments = parser.parse_args()
+   server = StubServer(('127.0.0.1', options.port), Library.generate(options.tracks))
+   server.latency = options.latency / 1000.0
+   if options.serve:
+      print 'Serving %i tracks on %s port %i' % (len(server.library.tracks), server.server_address[0], server.server_address[1])
+      server.serve_forever()
+   else:
+      server.start()
+      try:
+         if options.myfm:
+            benchmarkmyfm(server, options)
+         elif options.memory:
+            benchmarkmemory(server, options)
+         else:
+            benchmark(server, options)
+      finally:
+         server.shutdown()
+
+def benchmark(server, options): # {{{1
+   """
+   Run the benchmarks of the mpd module against the given stub server.
+   """
+   import mpd
+   class LineByLineClient(mpd.MPDClient):
+      # The parser used before responses were parsed a block of lines at a
+      # time, as the baseline.
+      def _readobjects(self, delimiters=[]):
+         obj = {}
+         for key, value in self._readitems():
+            key = key.lower()
+            if obj:
+               if key in delimiters:
+                  yield obj
+                  obj = {}
+               elif obj.has_key(key):
+                  if not isinstance(obj[key], list):
+                     obj[key] = [obj[key], value]
+                  else:
+                     obj[key].append(value)
+                  continue
+            obj[key] = value
+         if obj:
+            yield obj
+   baseline = LineByLineClient()
+   baseline.connect(*server.server_address)
+   client = mpd.MPDClient()
+   client.connect(*server.server_address)
+   try:
+      tracks = len(server.library.tracks)
+      for title, mpdclient, fields in (('listallinfo, line by line', baseline, None), ('listallinfo, all tags', client, None),
+            ('listallinfo, fields', client, ['file', 'artist', 'title', 'album', 'genre'])):
+         mpdclient.fields = fields
+         elapsed = best(lambda: mpdclient.listallinfo(), options.repeat)
+         print '%s: %i tracks in %.2f seconds (%.0f tracks/second)' % (title, tracks, elapsed, tracks / elapsed)
+      client.fields = None
+      # Commands sent one at a time take a round trip each, a batch takes
+      # one round trip in total.
+      album = [t[0][1] for t in server.library.tracks[:12]]
+      def addalbum():
+         for filename in album:
+            client.add(filename)
+      def addalbumbatch():
+         with client.batch() as batch:
+            for filename in album:
+               batch.add(filename)
+      version = [client.status()['playlist']]
+      def snapshot():
+         version[0] = client.status()['playlist']
+         client.plchanges(version[0])
+      def snapshotbatch():
+         batch = client.batch()
+         status = batch.status()
+         batch.plchanges(version[0])
+         batch.send()
+         version[0] = status.result()['playlist']
+      for title, function in (('adding an album of 12 tracks', addalbum), ('adding an album of 12 tracks, batched', addalbumbatch),
+            ('status and plchanges', snapshot), ('status and plchanges, batched', snapshotbatch)):
+         print '%s: %.1f ms' % (title, best(function, options.repeat) * 1000)
+   finally:
+      client.disconnect()
+      baseline.disconnect()
+
+def benchmarkmyfm(server, options): # {{{1
+   """
+   Run the main loop of mpd-myfm against the given stub server and a Last.fm
+   stub with similar artists for the artists in the library. Skip to the last
+   track in the play list after a random pause of up to twice the latency of
+   Last.fm, so that the similar artists of the last track are sometimes still
+   being fetched, and measure how long it takes before a track is added.
+   Meanwhile a remote control button is pressed every few milliseconds and
+   the time until it reaches MPD is measured, and every second a track is
+   added to the library so that mpd-myfm updates its index.
+   """
+   import imp
+   import shutil
+   import sys
+   import tempfile
+   import lastfm
+   import lastfmstub
+   library = server.library
+   fixtures = lastfmstub.Fixtures.generate(max(1, len(library.tracks) / 20), 0)
+   lastfmserver = lastfmstub.StubServer(('127.0.0.1', 0), fixtures)
+   lastfmserver.latency = options.lastfm_latency / 1000.0
+   lastfmserver.start()
+   directory = tempfile.mkdtemp(prefix='mpdstub-')
+   try:
+      lastfm.CACHE_DIRECTORY = directory
+      lastfm.SIMILAR_ARTISTS_URL = lastfmserver.similar_artists_url
+      lastfm.SECONDS_BETWEEN_REQUESTS = 0.01
+      myfm = imp.load_source('mpdmyfm', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mpd-myfm'))
+      myfm.pylirc = StubLirc()
+      lircrc = os.path.join(directory, 'lircrc')
+      open(lircrc, 'w').close()
+      sys.argv = ['mpd-myfm', '--host', server.server_address[0], '--port', str(server.server_address[1]),
+            '--songs', '1', '--indexfile', '', '--lirc', '--lircrc', lircrc]
+      myfmoptions, parser = myfm.getoptions()
+      # Don't let the configuration files get in the way.
+      myfmoptions.lastfmaccount = ''
+      myfmoptions.offline = myfmoptions.albummode = myfmoptions.daemonize = False
+      myfmoptions.pidfile = myfmoptions.logfile = ''
+      with server.lock:
+         library.add(library.tracks[0][0][1])
+         library.song = 0
+         library.state = 'play'
+      thread = threading.Thread(target=myfm.main, args=(myfmoptions, parser))
+      thread.setDaemon(True)
+      thread.start()
+      # Wait for the index to be built and the first track to be added.
+      while len(library.playlist) < 2:
+         time.sleep(0.01)
+      presses = []
+      stop = threading.Event()
+      def pressbuttons():
+         while not stop.isSet():
+            count = server.commands.get('volume', 0)
+            started = time.time()
+            myfm.pylirc.press('volumeup')
+            while server.commands.get('volume', 0) == count and time.time() - started < 10:
+               time.sleep(0.0005)
+            presses.append(time.time() - started)
+            time.sleep(random.uniform(0, 0.05))
+      presser = threading.Thread(target=pressbuttons)
+      presser.setDaemon(True)
+      presser.start()
+      def addtracks():
+         count = 0
+         while not stop.wait(1):
+            with server.lock:
+               tags = list(library.tracks[count % len(library.tracks)])
+               tags[0] = ('file', 'New/%i %s' % (count, tags[0][1]))
+               library.addtrack(tags, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+               library.dbupdate += 1
+               server.notify('database')
+            count += 1
+      adder = threading.Thread(target=addtracks)
+      adder.setDaemon(True)
+      adder.start()
+      picks = []
+      for i in xrange(options.picks):
+         time.sleep(random.uniform(0, 2 * lastfmserver.latency))
+         with server.lock:
+            length = len(library.playlist)
+            library.song = length - 1
+            server.notify('player')
+         started = time.time()
+         while len(library.playlist) == length and time.time() - started < 10:
+            time.sleep(0.0005)
+         picks.append(time.time() - started)
+      stop.set()
+      presser.join()
+      adder.join()
+      for title, timings in (('adding a track after skipping to the last one', picks), ('remote control button', presses)):
+         timings.sort()
+         print '%s: %i times, p50 %.1f ms, p90 %.1f ms, max %.1f ms' % (title, len(timings),
+               lastfmstub.percentile(timings, 50) * 1000, lastfmstub.percentile(timings, 90) * 1000, timings[-1] * 1000)
+   finally:
+      lastfmserver.shutdown()
+      shutil.rmtree(directory)
+
+def benchmarkmemory(server, options): # {{{1
+   """
+   Build the library index of mpd-myfm from the given stub server and print
+   how much the resident memory grew, compared with indexing the
+   dictionaries returned by listallinfo by artist, genre and album.
+   """
+   import imp
+   import mpd
+   myfm = imp.load_source('mpdmyfm', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mpd-myfm'))
+   def connect():
+      client = mpd.MPDClient()
+      client.connect(*server.server_address)
+      return client
+   def dictionaries():
+      index = ({}, {}, {}, {})
+      tracks = connect().listallinfo()
+      for track in tracks:
+         if 'file' in track:
+            for (field, tracksbykey) in zip(('artist', 'genre', 'album'), index):
+               tracksbykey.setdefault(myfm.simplifyname(track.get(field, '')), []).append(track)
+            index[3].setdefault(myfm.createkey(track.get('artist', ''), track.get('album', '')), []).append(track)
+      return index
+   def libraryindex():
+      return myfm.LibraryIndex(connect())
+   tracks = len(server.library.tracks)
+   for title, function in (('dictionaries returned by listallinfo', dictionaries), ('LibraryIndex', libraryindex)):
+      growth = measurememory(function)
+      print '%s: %.1f MB for %i tracks (%.0f bytes/track)' % (title, growth / 1048576.0, tracks, float(growth) / tracks)
+
+def measurememory(function): # {{{1
+   """
+   Call function in a child process and return by how many bytes its
+   resident memory grew while the result of function was still referenced.
+   """
+   def resident():
+      handle = open('/proc/self/statm')
+      try:
+         return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+      finally:
+         handle.close()
+   reader, writer = os.pipe()
+   pid = os.fork()
+   if pid == 0:
+      try:
+         os.close(reader)
+         gc.collect()
+         before = resident()
+         result = function()
+         gc.collect()
+         os.write(writer, str(resident() - before))
+      finally:
+         os._exit(0)
+   os.close(writer)
+   try:
+      growth = os.read(reader, 64)
+   finally:
+      os.close(reader)
+      os.waitpid(pid, 0)
+   return int(growth)
+
+def best(function, repeat): # {{{1
+   """
+   Call function repeat times and return the shortest time it took.
+   """
+   timings = []
+   for i in xrange(repeat):
+      started = time.time()
+      function()
+      timings.append(time.time() - started)
+   return min(timings)
+
+class Library: # {{{1
+   """
+   The data served by the stub server: the tracks in the library (lists of
+   (tag, value) tuples, the file name first), the modification times of the
+   directories, the play list (indexes into the tracks) and the status of
+   the player.
+   """
+
+   def __init__(self, tracks): # {{{2
+      self.tracks = []
+      self.files = {}
+      self.directories = {}
+      self.__rendered = None
+      self.__listing = None
+      for track in tracks:
+         self.addtrack(track, '2010-01-01T00:00:00Z')
+      self.playlist = []
+      # The play list version at which each position last changed.
+      self.versions = []
+      self.version = 1
+      self.song = -1
+      self.state = 'stop'
+      self.volume = 50
+      self.dbupdate = int(time.time())
+
+   def generate(cls, count): # {{{2
+      """
+      Generate a library with the given number of tracks by (count / 20)
+      artists with the tags that are common in real libraries.
+      """
+      generator = random.Random(42)
+      artists = max(1, count / 20)
+      tracks = []
+      for i in xrange(count):
+         artist = i % artists
+         album = (i / artists) % 3
+         tracks.append([
+            ('file', 'Artist %i/Album %i/%02i Track title %i.flac' % (artist, album, i % 13, i)),
+            ('Last-Modified', '2010-01-01T00:00:00Z'),
+            ('Time', str(generator.randint(120, 400))),
+            ('Artist', 'Artist %i' % artist),
+            ('Title', 'Track title %i' % i),
+            ('Album', 'Album %i' % album),
+            ('Track', '%i/13' % (i % 13)),
+            ('Date', str(1970 + artist % 40)),
+            ('Genre', 'Genre %i' % (artist % 40)),
+            ('AlbumArtist', 'Artist %i' % artist),
+            ('Disc', '1')])
+      return cls(tracks)
+   generate = classmethod(generate)
+
+   def render(self, track, position=None): # {{{2
+      lines = ['%s: %s' % tag for tag in self.tracks[track]]
+      if position is not None:
+         lines.append('Pos: %i' % position)
+         lines.append('Id: %i' % self.playlist[position])
+      return lines
+
+   def addtrack(self, tags, modified): # {{{2
+      """
+      Add a track to the library, like a file that was copied into the music
+      directory at the given time (in the format of Last-Modified). Call
+      update() to let the clients know.
+      """
+      self.files[tags[0][1]] = len(self.tracks)
+      self.tracks.append(tags)
+      # A directory changes when an entry is added to it, so a new directory
+      # changes its parent as well.
+      directory = os.path.dirname(tags[0][1])
+      while directory:
+         new = directory not in self.directories
+         self.directories[directory] = modified
+         if not new:
+            break
+         directory = os.path.dirname(directory)
+      self.__rendered = self.__listing = None
+
+   def listallinfo(self): # {{{2
+      # Large responses are only rendered once.
+      if self.__rendered is None:
+         lines = []
+         self.__render('', lines)
+         self.__rendered = lines
+      return self.__rendered
+
+   def lsinfo(self, directory): # {{{2
+      if directory and directory not in self.directories:
+         raise KeyError('directory not found')
+      subdirectories, tracks = self.__list(directory)
+      lines = []
+      for subdirectory in subdirectories:
+         lines.extend(['directory: %s' % subdirectory, 'Last-Modified: %s' % self.directories[subdirectory]])
+      for track in tracks:
+         lines.extend(self.render(track))
+      return lines
+
+   def __list(self, directory): # {{{2
+      # Get the subdirectories and the tracks in the given directory.
+      if self.__listing is None:
+         listing = {}
+         for subdirectory in sorted(self.directories):
+            listing.setdefault(os.path.dirname(subdirectory), ([], []))[0].append(subdirectory)
+         for (track, tags) in enumerate(self.tracks):
+            listing.setdefault(os.path.dirname(tags[0][1]), ([], []))[1].append(track)
+         self.__listing = listing
+      return self.__listing.get(directory, ([], []))
+
+   def __render(self, directory, lines): # {{{2
+      subdirectories, tracks = self.__list(directory)
+      for track in tracks:
+         lines.extend(self.render(track))
+      for subdirectory in subdirectories:
+         lines.extend(['directory: %s' % subdirectory, 'Last-Modified: %s' % self.directories[subdirectory]])
+         self.__render(subdirectory, lines)
+
+   def add(self, filename): # {{{2
+      if filename not in self.files:
+         raise KeyError('No such song')
+      self.version += 1
+      self.playlist.append(self.files[filename])
+      self.versions.append(self.version)
+
+class StubLirc: # {{{1
+   """
+   Stand-in for the pylirc module, so that benchmarks can press remote control
+   buttons. The descriptor returned by init() becomes readable when a button
+   is pressed, like the socket connected to lircd.
+   """
+
+   def __init__(self): # {{{2
+      self.__reader, self.__writer = os.pipe()
+      self.__codes = []
+
+   def init(self, program, lircrc, blocking=1): # {{{2
+      return self.__reader
+
+   def nextcode(self): # {{{2
+      if not self.__codes and select.select([self.__reader], [], [], 0)[0]:
+         self.__codes.extend(os.read(self.__reader, 4096).split())
+      if self.__codes:
+         return [self.__codes.pop(0)]
+      return None
+
+   def press(self, code): # {{{2
+      os.write(self.__writer, code + '\n')
+
+   def exit(self): # {{{2
+      pass
+
+class StubServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer): # {{{1
+   """
+   Threaded server that speaks the MPD protocol for the given Library. When
+   latency is set, every response is delayed by that many seconds. The
+   number of times each command was executed is kept in commands.
+   """
+
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, address, library): # {{{2
+      SocketServer.TCPServer.__init__(self, address, StubRequestHandler)
+      self.library = library
+      self.latency = 0
+      self.lock = threading.Lock()
+      self.commands = {}
+      self.__thread = None
+      # Pipes of the connections waiting in the idle command.
+      self.__idle = {}
+
+   def start(self): # {{{2
+      """
+      Start serving requests in a background thread.
+      """
+      self.__thread = threading.Thread(target=self.serve_forever)
+      self.__thread.setDaemon(True)
+      self.__thread.start()
+
+   def shutdown(self): # {{{2
+      """
+      Stop serving requests.
+      """
+      if self.__thread:
+         SocketServer.TCPServer.shutdown(self)
+         self.__thread = None
+      self.server_close()
+
+   def handle_error(self, request, client_address): # {{{2
+      # Clients disconnecting is business as usual.
+      pass
+
+   def notify(self, *subsystems): # {{{2
+      """
+      Wake up the connections waiting in the idle command for the given
+      subsystems. Has to be called with the lock held.
+      """
+      for (pipe, wanted) in self.__idle.items():
+         changed = [s for s in subsystems if not wanted or s in wanted]
+         if changed:
+            os.write(pipe, ''.join(['%s\n' % s for s in changed]))
+
+   def register(self, pipe, wanted): # {{{2
+      # Called with the lock held by connections entering and leaving idle.
+      if wanted is None:
+         self.__idle.pop(pipe, None)
+      else:
+         self.__idle[pipe] = wanted
+
+class StubRequestHandler(SocketServer.StreamRequestHandler): # {{{1
+
+   def setup(self): # {{{2
+      SocketServer.StreamRequestHandler.setup(self)
+      self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+   def handle(self): # {{{2
+      self.respond(['OK MPD 0.16.0'], False)
+      commandlist = None
+      while True:
+         line = self.rfile.readline()
+         if not line:
+            return
+         line = line.rstrip('\n')
+         if line in ('command_list_begin', 'command_list_ok_begin'):
+            commandlist = (line == 'command_list_ok_begin', [])
+         elif line == 'command_list_end' and commandlist:
+            listok, commands = commandlist
+            commandlist = None
+            response = []
+            for (position, command) in enumerate(commands):
+               result = self.execute(command, position)
+               response.extend(result)
+               if result and result[-1].startswith('ACK'):
+                  break
+               if listok:
+                  response.append('list_OK')
+            else:
+               response.append('OK')
+            self.respond(response)
+         elif commandlist:
+            commandlist[1].append(line)
+         elif line == 'noidle':
+            # The idle command ended before the noidle arrived.
+            continue
+         elif line.split(' ', 1)[0] == 'idle':
+            self.respond(self.idle(shlex.split(line)[1:]) + ['OK'])
+         else:
+            response = self.execute(line)
+            if not response or not response[-1].startswith('ACK'):
+               response.append('OK')
+            self.respond(response)
+
+   def respond(self, lines, delay=True): # {{{2
+      if delay and self.server.latency:
+         time.sleep(self.server.latency)
+      self.wfile.write('\n'.join(lines) + '\n')
+      self.wfile.flush()
+
+   def execute(self, line, position=0): # {{{2
+      """
+      Execute a command and return the lines of its response, without the
+      final OK.
+      """
+      arguments = shlex.split(line)
+      command = arguments.pop(0)
+      server = self.server
+      library = server.library
+      server.lock.acquire()
+      try:
+         server.commands[command] = server.commands.get(command, 0) + 1
+         if command in ('ping', 'password', 'volume', 'setvol', 'random', 'repeat'):
+            return []
+         if command == 'status':
+            status = ['volume: %i' % library.volume, 'repeat: 0', 'random: 0',
+                  'playlist: %i' % library.version, 'playlistlength: %i' % len(library.playlist),
+                  'state: %s' % library.state]
+            if library.song >= 0:
+               status.append('song: %i' % library.song)
+            return status
+         if command == 'stats':
+            return ['artists: %i' % max(1, len(library.tracks) / 20), 'songs: %i' % len(library.tracks),
+                  'db_update: %i' % library.dbupdate]
+         if command == 'listallinfo':
+            return list(library.listallinfo())
+         if command == 'listall':
+            return ['directory: %s' % d for d in sorted(library.directories)] + ['file: %s' % t[0][1] for t in library.tracks]
+         if command == 'lsinfo':
+            return library.lsinfo(arguments and arguments[0] or '')
+         if command == 'find' and arguments[:1] == ['modified-since']:
+            return []
+         if command == 'add':
+            library.add(arguments[0])
+            server.notify('playlist')
+            return []
+         if command == 'playlistinfo':
+            if arguments:
+               positions = [int(arguments[0])]
+               if positions[0] >= len(library.playlist):
+                  return ['ACK [2@%i] {playlistinfo} Bad song index' % position]
+            else:
+               positions = range(len(library.playlist))
+            return [line for p in positions for line in library.render(library.playlist[p], p)]
+         if command == 'plchanges':
+            version = int(arguments[0])
+            return [line for (p, v) in enumerate(library.versions) if v > version
+                  for line in library.render(library.playlist[p], p)]
+         if command in ('play', 'pause', 'stop'):
+            library.state = command
+            server.notify('player')
+            return []
+         if command in ('next', 'previous'):
+            if library.playlist:
+               step = command == 'next' and 1 or -1
+               library.song = min(max(library.song + step, 0), len(library.playlist) - 1)
+            server.notify('player')
+            return []
+         if command == 'update':
+            library.dbupdate = int(time.time())
+            server.notify('database')
+            return ['updating_db: 1']
+         return ['ACK [5@%i] {} unknown command "%s"' % (position, command)]
+      except (KeyError, ValueError, IndexError), error:
+         return ['ACK [50@%i] {%s} %s' % (position, command, error)]
+      finally:
+         server.lock.release()
+
+   def idle(self, wanted): # {{{2
+      """
+      Wait until one of the wanted subsystems changes or the client sends
+      noidle, and return the lines of the response.
+      """
+      reader, writer = os.pipe()
+      self.server.lock.acquire()
+      self.server.register(writer, wanted)
+      self.server.lock.release()
+      try:
+         while True:
+            readable = select.select([self.connection, reader], [], [])[0]
+            if reader in readable:
+               changed = os.read(reader, 4096).split()
+               return ['changed: %s' % s for s in sorted(set(changed))]
+            if self.connection in readable:
+               line = self.rfile.readline()
+               if not line or line.startswith('noidle'):
+                  return []
+      finally:
+         self.server.lock.acquire()
+         self.server.register(writer, None)
+         self.server.lock.release()
+         os.close(reader)
+         os.close(writer)
+
+if __name__ == '__main__':
+   main()